@@ -1,8 +1,8 @@
 from typing import Union, Tuple, Mapping, Literal, Callable, Sequence
 from functools import partial
 from itertools import combinations, product
-from multiprocessing import Pool
 from pathlib import Path
+import heapq
 import warnings
 
 import numpy as np
@@ -11,8 +11,10 @@ import xarray as xr
 import xrft
 from tqdm.notebook import tqdm, trange
 from scipy.spatial.distance import squareform
-from scipy.cluster.hierarchy import linkage, cut_tree
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import csr_matrix
 from sklearn.metrics import pairwise_distances
+from sklearn.feature_extraction.image import grid_to_graph
 from xclim.indices.run_length import rle, run_bounds # TODO: replace with basic run_lengths to drop xclim dependency
 from sklearn.inspection import permutation_importance
 from sklearn.model_selection import train_test_split
@@ -26,17 +28,17 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from xgboost import XGBClassifier, XGBRegressor
 from fasttreeshap import TreeExplainer, Explainer
+from dask.base import tokenize
 from dask.diagnostics import ProgressBar
 
 from jetstream_hugo.definitions import (
     DEFAULT_VALUES,
-    YEARS,
     COMPUTE_KWARGS,
     N_WORKERS,
     RESULTS,
     load_pickle,
     save_pickle,
-    get_runs_fill_holes,
+    get_runs_fill_holes_nd,
 )
 from jetstream_hugo.data import (
     find_spot,
@@ -65,6 +67,27 @@ ALL_SCORES = {
 }
 
 
+def find_spells(
+    da: xr.DataArray,
+    q: float = 0.95,
+    fill_holes: int = 0,
+    minlen: np.timedelta64 = np.timedelta64(3, "D"),
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Spells of da beyond its q quantile, for da of dims (time,) or (time, region), all regions at once. Runs come from get_runs_fill_holes_nd, then only runs within one year and lasting at least minlen are kept. Returns start and end (inclusive) time indices, region index and length in days of every spell, sorted by region then start.
+    """
+    days = quantile_exceedence(da, q).transpose("time", ...).values
+    start, end, region = get_runs_fill_holes_nd(
+        days.reshape(days.shape[0], -1), hole_size=fill_holes
+    )
+    times = da.time.values
+    years = times.astype("datetime64[Y]")
+    durations = times[end] - times[start]
+    keep = (years[start] == years[end]) & (durations >= minlen)
+    lengths = durations[keep].astype("timedelta64[D]").astype(int)
+    return start[keep], end[keep], region[keep], lengths
+
+
 def spells_from_da(
     da: xr.DataArray,
     q: float = 0.95,
@@ -74,96 +97,128 @@ def spells_from_da(
     time_after: np.timedelta64 = np.timedelta64(0, "D"),
     output_type: Literal["arr"] | Literal["list"] | Literal["both"] = "arr",
 ) -> xr.DataArray | Tuple[list[np.ndarray]]:
-    dt = pd.Timedelta(da.time.values[1] - da.time.values[0])
-    months = np.unique(da.time.dt.month.values)
-    months = [str(months[0]).zfill(2), str(min(12, months[-1] + 1)).zfill(2)]
-    days = quantile_exceedence(da, q)   
-    runs = get_runs_fill_holes(days.values.copy(), hole_size=fill_holes)
-    run_times = [da.time.values[run] for run in runs]
-    spells = []
-    spells_ts = []
-    lengths = []
-    for run in run_times:
-        years = run.astype('datetime64[Y]').astype(int) + 1970
-        cond1 = years[0] == years[-1]
-        len_ = run[-1] - run[0]
-        cond2 = len_ >= minlen
-        if not (cond1 and cond2):
-            continue
-        spells.append([run[0], run[-1]])
-        ts_extended = pd.date_range(run[0] - time_before, run[-1] + time_after, freq=dt).values
-        ts_extended = ts_extended[np.isin(ts_extended, da.time.values)]
-        spells_ts.append(ts_extended)
-        lengths.append(len_.astype("timedelta64[D]").astype(int))
-    spells = np.asarray(spells)
+    """
+    Spells of da (see find_spells), extended by time_before and time_after. For a (time, region) da, spells_ts and spells are lists over regions.
+    """
+    times = da.time.values
+    dt = times[1] - times[0]
+    time_before = pd.Timedelta(time_before).to_timedelta64()
+    time_after = pd.Timedelta(time_after).to_timedelta64()
+    start, end, region, lengths = find_spells(da, q, fill_holes, minlen)
+    spells = np.stack([times[start], times[end]], axis=1)
+
+    first = np.searchsorted(times, times[start] - time_before)
+    last = np.searchsorted(times, times[end] + time_after, side="right")
+    sizes = last - first
+    spell_id = np.repeat(np.arange(len(start)), sizes)
+    indices = first[spell_id] + np.arange(sizes.sum()) - (np.cumsum(sizes) - sizes)[spell_id]
+    on_grid = (times[indices] - times[start][spell_id]) % dt == np.timedelta64(0)
+    indices, spell_id = indices[on_grid], spell_id[on_grid]
+    sizes = np.bincount(spell_id, minlength=len(start))
+    if len(start) > 0:
+        spells_ts = np.split(times[indices], np.cumsum(sizes)[:-1])
+    else:
+        spells_ts = []
+
+    da_spells = da.transpose("time", ...)
+    arr_spells = np.zeros((len(times), int(np.prod(da_spells.shape[1:]))), dtype=int)
+    arr_spells[indices, region[spell_id]] = lengths[spell_id]
+    da_spells = da_spells.copy(data=arr_spells.reshape(da_spells.shape)).transpose(
+        *da.dims
+    )
+    if da.ndim > 1:
+        bounds = np.cumsum(np.bincount(region, minlength=arr_spells.shape[1]))[:-1]
+        spells_ts = [
+            spells_ts[first:last]
+            for first, last in zip([0, *bounds], [*bounds, len(spells_ts)])
+        ]
+        spells = np.split(spells, bounds)
     if output_type == "list":
         return spells_ts, spells
-    da_spells = da.copy(data=np.zeros(da.shape, dtype=int))
-    indexer = np.concatenate(spells_ts)
-    lengths = np.concatenate([np.full(len(spell_ts), len_) for spell_ts, len_ in zip(spells_ts, lengths)])
-    da_spells.loc[indexer] = lengths
-
     if output_type == "arr":
         return da_spells
     return spells_ts, spells, da_spells
 
 
+def _spell_bounds(
+    spells_ts: list, spells: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # spell starts, first and last time of the extended spells, offsets of the longest extended spell around its start, and spell lengths. Empty extended spells are skipped
+    spells = np.asarray(spells, dtype="datetime64[ns]").reshape(-1, 2)
+    keep = [i for i, ts in enumerate(spells_ts) if len(ts) > 0]
+    spells_ts = [np.asarray(spells_ts[i], dtype="datetime64[ns]") for i in keep]
+    spells = spells[keep]
+    firsts = np.asarray([ts[0] for ts in spells_ts], dtype="datetime64[ns]")
+    lasts = np.asarray([ts[-1] for ts in spells_ts], dtype="datetime64[ns]")
+    lengths = spells[:, 1] - spells[:, 0]
+    if len(spells) == 0:
+        offsets = np.atleast_1d(np.timedelta64(0, "ns"))
+        return spells[:, 0], firsts, lasts, offsets, lengths
+    longest_spell = np.argmax(lengths)
+    offsets = spells_ts[longest_spell] - spells[longest_spell, 0]
+    return spells[:, 0], firsts, lasts, offsets, lengths
+
+
+def composite_spells(
+    da: xr.DataArray,
+    ds: xr.Dataset | xr.DataArray,
+    starts: np.ndarray,
+    firsts: np.ndarray,
+    lasts: np.ndarray,
+    offsets: np.ndarray,
+    offset_mask: np.ndarray | None = None,
+) -> xr.Dataset | xr.DataArray:
+    """
+    Composites of ds around spell starts of shape (spell,) or (region, spell), NaT for padding. Start plus offset give one integer gather index into ds.time, taken once for all variables. Entries whose time is missing or outside [firsts, lasts], the extended spell, are masked to NaN, as are those where offset_mask, broadcast against (..., spell, offset), is False. da, of dims (time,) or (time, region), gives the avg_val coordinate.
+    """
+    dims = ["region", "spell", "time_around_beg"][-starts.ndim - 1 :]
+    target = starts[..., None] + offsets
+    valid = (target >= firsts[..., None]) & (target <= lasts[..., None])
+    if offset_mask is not None:
+        valid &= offset_mask
+    index = {}
+    for name, times in zip(["da", "ds"], [da.time.values, ds.time.values]):
+        index[name] = np.clip(np.searchsorted(times, target), 0, len(times) - 1)
+        valid &= times[index[name]] == target
+    da = da.transpose("time", ...).values
+    if da.ndim == 1:
+        avg_val = da[index["da"]]
+    else:
+        avg_val = da[index["da"], np.arange(da.shape[1])[:, None, None]]
+    valid_da = xr.DataArray(valid, dims=dims)
+    composite = ds.isel(time=xr.DataArray(index["ds"], dims=dims))
+    composite = composite.where(valid_da).drop_vars("time")
+    composite = composite.assign_coords(
+        {
+            "spell": np.arange(starts.shape[-1]),
+            "time_around_beg": offsets,
+            "avg_val": (dims, np.where(valid, avg_val, np.nan)),
+            "absolute_time": (dims, np.where(valid, target, np.datetime64("NaT"))),
+        }
+    )
+    return composite.transpose(*dims, ...)
+
+
+def _warn_time_before(time_before) -> None:
+    if time_before is not None:
+        warnings.warn(
+            "time_before is ignored and will be removed, spells_ts already holds the extended spells",
+            DeprecationWarning,
+            stacklevel=3,
+        )
+
+
 def mask_from_spells(
     da: xr.DataArray,
     ds: xr.Dataset,
     spells_ts: list,
     spells: np.ndarray,
-    time_before: np.timedelta64 = np.timedelta64(0, "D"),
+    time_before: np.timedelta64 | None = None,
 ) -> xr.Dataset:
-    months = np.unique(ds.time.dt.month.values)
-    months = [str(months[0]).zfill(2), str(min(12, months[-1] + 1)).zfill(2)]
-    try:
-        lengths = spells[:, 1] - spells[:, 0]
-        longest_spell = np.argmax(lengths)
-        time_around_beg = spells_ts[longest_spell] - spells[longest_spell, 0]
-    except ValueError:
-        time_around_beg = np.atleast_1d(np.timedelta64(0, "ns"))
-    ds_masked = (
-        ds.loc[dict(time=ds.time.values[0])]
-        .reset_coords("time", drop=True)
-        .copy(deep=True)
-    )
-    ds_masked.loc[dict()] = np.nan
-    ds_masked = ds_masked.expand_dims(
-        spell=np.arange(len(spells)),
-        time_around_beg=time_around_beg,
-    ).copy(deep=True)
-    ds_masked = ds_masked.assign_coords(lengths=("spell", lengths))
-    dims = list(ds_masked.sizes.values())[:2]
-    dummy_da = np.zeros(dims) + np.nan
-    ds_masked = ds_masked.assign_coords(
-        avg_val=(["spell", "time_around_beg"], dummy_da)
-    )
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=UserWarning)
-        ds_masked = ds_masked.assign_coords(
-            absolute_time=(
-                ["spell", "time_around_beg"],
-                dummy_da.astype("datetime64[h]"),
-            )
-        )
-    if len(ds_masked.time_around_beg) <= 1:
-        return ds_masked
-    for i, spell in enumerate(spells_ts):
-        unexpected_offset = time_before - (spells[i][0] - spell[0])
-        this_tab = time_around_beg[: len(spell)] + unexpected_offset
-        this_tab = np.clip(this_tab, None, ds_masked.time_around_beg.max().values) # Unexpected offset is weird
-        spell = spell[:len(this_tab)]
-        to_assign = (
-            ds.loc[dict(time=spell)]
-            .assign_coords(time=this_tab)
-            .rename(time="time_around_beg")
-        )
-        indexer = dict(spell=i, time_around_beg=this_tab)
-        ds_masked.loc[indexer] = to_assign
-        ds_masked.avg_val.loc[indexer] = da.loc[dict(time=spell)].values
-        ds_masked.absolute_time.loc[indexer] = spell
-    return ds_masked
+    _warn_time_before(time_before)
+    starts, firsts, lasts, offsets, lengths = _spell_bounds(spells_ts, spells)
+    ds_masked = composite_spells(da, ds, starts, firsts, lasts, offsets)
+    return ds_masked.assign_coords(lengths=("spell", lengths))
 
 
 def mask_name(mask: xr.DataArray | Literal["land"] | None = None) -> str:
@@ -186,7 +241,7 @@ def mask_from_da(
     spells_ts, spells = spells_from_da(
         da, q, fill_holes, minlen, time_before, time_after, output_type="list"
     )
-    return mask_from_spells(da, ds, spells_ts, spells, time_before)
+    return mask_from_spells(da, ds, spells_ts, spells)
 
 
 def mask_from_spells_multi_region(
@@ -194,24 +249,36 @@ def mask_from_spells_multi_region(
     targets: xr.DataArray,
     all_spells_ts: list,
     all_spells: list,
-    time_before: pd.Timedelta = pd.Timedelta(0, "D"),
+    time_before: pd.Timedelta | None = None,
 ):
-    all_masked_ts = []
-    for spells_ts, spells, target in zip(
-        all_spells_ts, all_spells, targets.transpose("region", ...)
-    ):
-        masked_ts = mask_from_spells(
-            target,
-            timeseries,
-            spells_ts,
-            spells,
-            time_before=time_before,
-        )
-        all_masked_ts.append(masked_ts)
-    regions = targets.region.values
-    regions = xr.DataArray(regions, name="region", dims="region")
-    all_masked_ts = xr.concat(all_masked_ts, dim=regions)
-    return all_masked_ts
+    """
+    Composites of timeseries around the spells of every region. Like concatenating mask_from_spells over regions, an offset only gets values in the regions whose own longest spell spans it, and is NaN in the others.
+    """
+    _warn_time_before(time_before)
+    n_spells = max([len(spells_ts) for spells_ts in all_spells_ts] + [0])
+    shape = (len(all_spells), n_spells)
+    starts, firsts, lasts = [np.full(shape, np.datetime64("NaT"), dtype="datetime64[ns]") for _ in range(3)]
+    lengths = np.full(shape, np.timedelta64("NaT"), dtype="timedelta64[ns]")
+    all_offsets = []
+    for i, (spells_ts, spells) in enumerate(zip(all_spells_ts, all_spells)):
+        bounds = _spell_bounds(spells_ts, spells)
+        n = len(bounds[0])
+        starts[i, :n], firsts[i, :n], lasts[i, :n], offsets, lengths[i, :n] = bounds
+        all_offsets.append(offsets)
+    offsets = np.unique(np.concatenate(all_offsets))
+    offset_mask = np.stack([np.isin(offsets, these) for these in all_offsets])
+    all_masked_ts = composite_spells(
+        targets.transpose("time", "region"),
+        timeseries,
+        starts,
+        firsts,
+        lasts,
+        offsets,
+        offset_mask[:, None, :],
+    )
+    return all_masked_ts.assign_coords(
+        region=targets.region.values, lengths=(("region", "spell"), lengths)
+    )
 
 
 def quantile_exceedence(  # 2 directional based on quantile above or below 0.5
@@ -222,35 +289,336 @@ def quantile_exceedence(  # 2 directional based on quantile above or below 0.5
     return da < da.quantile(q, dim=dim)
 
 
-def spatial_agglomerative_clustering(
+def _exceedances_flat(
     da: xr.DataArray,
     condition_function: Callable = lambda x: x,
     mask: xr.DataArray | Literal["land"] | None = None,
     season: str | list | None = "JJA",
-    metric: str = "jaccard",
-) -> np.ndarray:
+) -> Tuple[np.ndarray, np.ndarray]:
+    # (time, point) exceedances of the points to cluster, and the (lat, lon) mask that selects them
     lon, lat = da.lon.values, da.lat.values
     if mask is not None and not isinstance(mask, xr.DataArray) and mask == "land":
         mask = get_land_mask()
     if mask is not None:
-        mask = mask.sel(lon=lon, lat=lat)
+        mask = mask.sel(lon=lon, lat=lat).transpose("lat", "lon").values.astype(bool)
+    else:
+        mask = np.ones((len(lat), len(lon)), dtype=bool)
     da = extract_season(da, season)
-    to_cluster = condition_function(da)
-    stack_dims = {"lat_lon": ("lat", "lon")}
-    to_cluster_flat = to_cluster.stack(stack_dims)
-    if mask is not None:
-        mask_flat = mask.stack(stack_dims)
-        to_cluster_flat = to_cluster_flat.values[:, mask_flat.values]
+    to_cluster = condition_function(da).transpose("time", "lat", "lon")
+    to_cluster_flat = to_cluster.values.reshape(to_cluster.shape[0], -1)
+    return to_cluster_flat[:, mask.ravel()], mask
+
+
+def spatial_agglomerative_clustering(
+    da: xr.DataArray,
+    condition_function: Callable = lambda x: x,
+    mask: xr.DataArray | Literal["land"] | None = None,
+    season: str | list | None = "JJA",
+    metric: str = "jaccard",
+) -> np.ndarray:
+    to_cluster_flat, _ = _exceedances_flat(da, condition_function, mask, season)
+    if metric == "jaccard":
+        return squareform(jaccard_distances(pack_bitsets(to_cluster_flat)))
     return pairwise_distances(to_cluster_flat.T, metric=metric, n_jobs=N_WORKERS)
 
 
-def _add_timescales(predictors, timescales: Sequence, indexer: Mapping):
-    for timescale in timescales[1:]:
-        indexer["timescale"] = timescale
-        predictors.loc[indexer] = (
-            predictors.loc[indexer].rolling(time=timescale, center=False).mean()
+def pack_bitsets(to_cluster_flat: np.ndarray) -> np.ndarray:
+    """
+    Boolean (time, point) array packed into one bitset of 64 bit words per point, zero-padded, of shape (point, word).
+    """
+    bits = np.packbits(np.asarray(to_cluster_flat, dtype=bool).T, axis=1)
+    pad = -bits.shape[1] % 8
+    bits = np.pad(bits, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    # number of set bits along the last axis of an uint64 array
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    words = np.ascontiguousarray(words).view(np.uint8)
+    return _POPCOUNT_TABLE[words].sum(axis=-1, dtype=np.int64)
+
+
+def _jaccard_from_counts(
+    intersection: np.ndarray, counts_1: np.ndarray, counts_2: np.ndarray
+) -> np.ndarray:
+    union = counts_1 + counts_2 - intersection
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(union > 0, 1 - intersection / union, 0.0)
+
+
+def _bitset_block_size(bits: np.ndarray, n_cols: int, max_bytes: int = 2**27) -> int:
+    return max(1, max_bytes // max(1, n_cols * bits.shape[1] * bits.itemsize))
+
+
+def jaccard_distances(bits: np.ndarray, block_size: int | None = None) -> np.ndarray:
+    """
+    Condensed Jaccard distance matrix of packed bitsets (see pack_bitsets), filled block_size rows at a time with popcounts of the bitwise and. Equals pdist(X, "jaccard") on the unpacked points.
+    """
+    n = bits.shape[0]
+    counts = _popcount(bits)
+    if block_size is None:
+        block_size = _bitset_block_size(bits, n)
+    distances = np.empty(n * (n - 1) // 2)
+    for start in range(0, n - 1, block_size):
+        end = min(start + block_size, n - 1)
+        intersection = _popcount(bits[start:end, None, :] & bits[None, start + 1 :, :])
+        block = _jaccard_from_counts(
+            intersection, counts[start:end, None], counts[None, start + 1 :]
         )
-    return predictors
+        for i in range(start, end):
+            offset = i * (2 * n - i - 1) // 2
+            distances[offset : offset + n - i - 1] = block[i - start, i - start :]
+    return distances
+
+
+def jaccard_edge_distances(
+    bits: np.ndarray, rows: np.ndarray, cols: np.ndarray, block_size: int = 2**16
+) -> np.ndarray:
+    """
+    Jaccard distances between the packed bitsets of the given pairs of points.
+    """
+    counts = _popcount(bits)
+    distances = np.empty(len(rows))
+    for start in range(0, len(rows), block_size):
+        end = min(start + block_size, len(rows))
+        r, c = rows[start:end], cols[start:end]
+        intersection = _popcount(bits[r] & bits[c])
+        distances[start:end] = _jaccard_from_counts(intersection, counts[r], counts[c])
+    return distances
+
+
+def jaccard_knn_graph(
+    bits: np.ndarray, n_neighbors: int = 20, block_size: int | None = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    n_neighbors nearest neighbours of every point in Jaccard distance, from packed bitsets in blocks of rows, never holding more than block_size x n distances. Returns rows, cols and distances of the edges.
+    """
+    n = bits.shape[0]
+    n_neighbors = min(n_neighbors, n - 1)
+    counts = _popcount(bits)
+    if block_size is None:
+        block_size = _bitset_block_size(bits, n)
+    rows, cols, dists = [], [], []
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        intersection = _popcount(bits[start:end, None, :] & bits[None, :, :])
+        block = _jaccard_from_counts(intersection, counts[start:end, None], counts[None, :])
+        block[np.arange(end - start), np.arange(start, end)] = np.inf
+        nearest = np.argpartition(block, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        rows.append(np.repeat(np.arange(start, end), n_neighbors))
+        cols.append(nearest.ravel())
+        dists.append(np.take_along_axis(block, nearest, axis=1).ravel())
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+
+def sparse_average_linkage(
+    n: int, rows: np.ndarray, cols: np.ndarray, distances: np.ndarray
+) -> np.ndarray:
+    """
+    Average linkage restricted to the edges of a sparse graph, as scipy linkage matrix. Merged clusters keep the size-weighted mean distance to neighbours of both, or the distance to a neighbour of only one of them. Disconnected components are merged last, at the largest merge distance.
+    """
+    neighbours = [dict() for _ in range(2 * n - 1)]
+    for r, c, d in zip(rows.tolist(), cols.tolist(), distances.tolist()):
+        if r != c:
+            neighbours[r][c] = neighbours[c][r] = d
+    heap = [(d, r, c) for r in range(n) for c, d in neighbours[r].items() if r < c]
+    heapq.heapify(heap)
+    sizes = np.ones(2 * n - 1)
+    active = np.zeros(2 * n - 1, dtype=bool)
+    active[:n] = True
+    Z = np.zeros((n - 1, 4))
+    node = n
+    while heap:
+        d, i, j = heapq.heappop(heap)
+        if not (active[i] and active[j]):
+            continue
+        active[i] = active[j] = False
+        sizes[node] = sizes[i] + sizes[j]
+        merged = neighbours[node]
+        for k in neighbours[i].keys() | neighbours[j].keys():
+            if not active[k]:
+                continue
+            if k in neighbours[i] and k in neighbours[j]:
+                dk = (sizes[i] * neighbours[i][k] + sizes[j] * neighbours[j][k]) / sizes[node]
+            else:
+                dk = neighbours[i].get(k, neighbours[j].get(k))
+            neighbours[k].pop(i, None)
+            neighbours[k].pop(j, None)
+            neighbours[k][node] = merged[k] = dk
+            heapq.heappush(heap, (dk, k, node))
+        neighbours[i], neighbours[j] = None, None
+        Z[node - n] = i, j, d, sizes[node]
+        active[node] = True
+        node += 1
+    d = Z[: node - n, 2].max() if node > n else 0.0
+    roots = np.nonzero(active)[0]
+    while node < 2 * n - 1:
+        i, j = roots[0], roots[1]
+        sizes[node] = sizes[i] + sizes[j]
+        Z[node - n] = i, j, d, sizes[node]
+        roots = np.append(roots[2:], node)
+        node += 1
+    return Z
+
+
+def cut_linkage(Z: np.ndarray, n_clu: int) -> np.ndarray:
+    """
+    Same labels as scipy's cut_tree(Z, n_clu)[:, 0], by replaying the first merges of Z on a parent array. Linear in the number of points where cut_tree is quadratic.
+    """
+    n = Z.shape[0] + 1
+    parent = np.arange(2 * n - 1)
+    n_merges = n - n_clu
+    children = Z[:n_merges, :2].astype(int)
+    parent[children[:, 0]] = parent[children[:, 1]] = n + np.arange(n_merges)
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    _, first, inverse = np.unique(parent[:n], return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def region_weights(
+    clusters_da: xr.DataArray, n_clu: int, area_weights: bool = False
+) -> csr_matrix:
+    """
+    Sparse (region, lat * lon) matrix of the gridpoints of each cluster, weighted by cos(lat) if area_weights.
+    """
+    clusters_da = clusters_da.transpose("lat", "lon")
+    labels = clusters_da.values.ravel()
+    weights = np.ones(clusters_da.shape)
+    if area_weights:
+        weights = weights * np.cos(np.deg2rad(clusters_da.lat.values))[:, None]
+    weights = weights.ravel()
+    valid = np.isfinite(labels) & (labels >= 0) & (labels < n_clu)
+    return csr_matrix(
+        (weights[valid], (labels[valid].astype(int), np.nonzero(valid)[0])),
+        shape=(n_clu, len(labels)),
+    )
+
+
+def _regional_means(arr: np.ndarray, weights: csr_matrix) -> np.ndarray:
+    # nan-skipping weighted means of arr (..., lat, lon) over every region at once
+    flat = arr.reshape(-1, weights.shape[1]).T
+    finite = np.isfinite(flat)
+    sums = weights @ np.where(finite, flat, 0)
+    norms = weights @ finite.astype(weights.dtype)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (sums / norms).T
+    return means.reshape(*arr.shape[:-2], weights.shape[0])
+
+
+def regional_means(
+    da: xr.DataArray,
+    clusters_da: xr.DataArray,
+    n_clu: int,
+    area_weights: bool = False,
+) -> xr.DataArray:
+    """
+    Means of da over every cluster of clusters_da in one pass, one sparse region-weight matrix product per time chunk. Without area_weights, equal to da.where(clusters_da == i).mean(["lon", "lat"]) for each region i.
+    """
+    clusters_da = clusters_da.sel(lat=da.lat.values, lon=da.lon.values)
+    weights = region_weights(clusters_da, n_clu, area_weights)
+    if da.chunks is not None:
+        da = da.chunk({"lat": -1, "lon": -1})
+    means = xr.apply_ufunc(
+        _regional_means,
+        da,
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[["region"]],
+        kwargs={"weights": weights},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs={"output_sizes": {"region": n_clu}},
+    )
+    return means.assign_coords(region=np.arange(n_clu))
+
+
+def _segment_bounds(time: np.ndarray, yearbreak: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    # index of the first and last time step of the year (or of the whole series) of every time step
+    n_time = len(time)
+    if yearbreak:
+        years = time.astype("datetime64[Y]")
+        new = np.concatenate([[True], years[1:] != years[:-1]])
+    else:
+        new = np.zeros(n_time, dtype=bool)
+        new[0] = True
+    idx = np.arange(n_time)
+    firsts = np.maximum.accumulate(np.where(new, idx, 0))
+    last = np.concatenate([new[1:], [True]])
+    lasts = np.minimum.accumulate(np.where(last, idx, n_time - 1)[::-1])[::-1]
+    return firsts, lasts
+
+
+def rolling_means_nd(
+    arr: np.ndarray,
+    firsts: np.ndarray,
+    lasts: np.ndarray,
+    windows: Sequence[int],
+    forward: bool = False,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Rolling means of arr (time, ...) for every window at once, written into out (time, ..., window), float32 by default. Windows are trailing, or leading if forward, and never cross the segment bounds firsts / lasts (see _segment_bounds): those time steps and windows containing NaNs are NaN, like xarray's rolling mean. All windows come from one cumsum of the anomalies to the column means.
+    """
+    if out is None:
+        out = np.empty((*arr.shape, len(windows)), dtype=np.float32)
+    n_time = arr.shape[0]
+    isnan = np.isnan(arr)
+    offset = np.nanmean(arr, axis=0, keepdims=True)
+    zeros = np.zeros((1, *arr.shape[1:]))
+    sums = np.concatenate([zeros, np.cumsum(np.where(isnan, 0, arr - offset), axis=0)])
+    nans = np.concatenate([zeros, np.cumsum(isnan, axis=0)])
+    idx = np.arange(n_time)
+    for k, window in enumerate(windows):
+        if forward:
+            lo, hi = idx, idx + window
+            valid = hi - 1 <= lasts
+        else:
+            lo, hi = idx + 1 - window, idx + 1
+            valid = lo >= firsts
+        lo, hi = np.clip(lo, 0, n_time), np.clip(hi, 0, n_time)
+        means = (sums[hi] - sums[lo]) / window + offset
+        valid = valid.reshape(-1, *[1] * (arr.ndim - 1)) & (nans[hi] == nans[lo])
+        out[..., k] = np.where(valid, means, np.nan)
+    return out
+
+
+def lags_nd(
+    arr: np.ndarray,
+    firsts: np.ndarray,
+    lags: Sequence[int],
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    arr (time, ...) shifted by every non-negative lag at once, written into out (time, ..., lag), float32 by default. Values that would come from before the segment start firsts are NaN.
+    """
+    if np.any(np.asarray(lags) < 0):
+        raise ValueError(f"Lags must be non-negative, got {list(lags)}")
+    if out is None:
+        out = np.empty((*arr.shape, len(lags)), dtype=np.float32)
+    idx = np.arange(arr.shape[0])
+    for k, lag in enumerate(lags):
+        valid = (idx - lag >= firsts).reshape(-1, *[1] * (arr.ndim - 1))
+        out[..., k] = np.where(valid, arr[np.clip(idx - lag, 0, None)], np.nan)
+    return out
+
+
+def _with_time_features(
+    da: xr.DataArray, builder: Callable, dim: str, values: Sequence, **kwargs
+) -> xr.DataArray:
+    # apply a feature builder along time and append its features as a new last dimension
+    time_axis = da.get_axis_num("time")
+    arr = np.moveaxis(da.values, time_axis, 0)
+    out = builder(arr, **kwargs)
+    out = np.moveaxis(out, 0, time_axis)
+    return da.expand_dims(axis=-1, **{dim: values}).copy(data=out)
 
 
 def add_timescales_to_predictors(
@@ -259,41 +627,26 @@ def add_timescales_to_predictors(
     if 1 not in timescales:
         timescales.append(1)
     timescales.sort()
-    predictors = predictors.expand_dims(axis=-1, **dict(timescale=timescales)).copy(
-        deep=True
+    firsts, lasts = _segment_bounds(predictors.time.values, yearbreak)
+    return _with_time_features(
+        predictors,
+        rolling_means_nd,
+        "timescale",
+        timescales,
+        firsts=firsts,
+        lasts=lasts,
+        windows=timescales,
     )
-    if not yearbreak:
-        return _add_timescales(predictors, timescales, {})
-    for year in np.unique(predictors.time.dt.year):
-        year_mask = predictors.time.dt.year == year
-        indexer = {"time": year_mask}
-        predictors.loc[indexer] = _add_timescales(
-            predictors, timescales, indexer.copy()
-        ).loc[indexer]
-    return predictors
-
-
-def _add_lags(predictors, lags: Sequence, indexer: Mapping):
-    for lag in lags[1:]:
-        indexer["lag"] = lag
-        predictors.loc[indexer] = predictors.loc[indexer].shift(time=lag)
-    return predictors
 
 
 def add_lags_to_predictors(predictors, lags: Sequence, yearbreak: bool = True):
     if 0 not in lags:
         lags.append(0)
     lags.sort()
-    predictors = predictors.expand_dims(axis=-1, **dict(lag=lags)).copy(deep=True)
-    if not yearbreak:
-        return _add_lags(predictors, lags, {})
-    for year in np.unique(predictors.time.dt.year):
-        year_mask = predictors.time.dt.year == year
-        indexer = {"time": year_mask}
-        predictors.loc[indexer] = _add_lags(predictors, lags, indexer.copy()).loc[
-            indexer
-        ]
-    return predictors
+    firsts, _ = _segment_bounds(predictors.time.values, yearbreak)
+    return _with_time_features(
+        predictors, lags_nd, "lag", lags, firsts=firsts, lags=lags
+    )
 
 
 def prepare_predictors(
@@ -350,18 +703,18 @@ def prepare_predictors(
 
 
 def augment_targets(targets, timescales):
-    targets = targets.expand_dims(axis=-1, **dict(timescale=timescales)).copy(deep=True)
-    for timescale in tqdm(timescales[1:]):
-        for year in np.unique(targets.time.dt.year):
-            year_mask = targets.time.dt.year == year
-            indexer = {"time": year_mask, "timscale": timescale}
-            targets.loc[indexer] = (
-                targets.loc[indexer]
-                .rolling(time=timescale, center=False)
-                .mean()
-                .shift(time=-timescale + 1)
-            )
-    return targets
+    # leading means over the next timescale steps within each year, the first timescale is kept as is
+    firsts, lasts = _segment_bounds(targets.time.values)
+    return _with_time_features(
+        targets,
+        rolling_means_nd,
+        "timescale",
+        timescales,
+        firsts=firsts,
+        lasts=lasts,
+        windows=[1, *timescales[1:]],
+        forward=True,
+    )
 
 
 def create_all_triplets(
@@ -378,75 +731,135 @@ def create_all_triplets(
     return triplets
 
 
-def stacked_lstsq(
-    L, b, rcond=1e-10
-):  # https://stackoverflow.com/questions/30442377/how-to-solve-many-overdetermined-systems-of-linear-equations-using-vectorized-co
+def _target_timescale(targets: xr.DataArray) -> Tuple[xr.DataArray, int]:
+    if "timescale" in targets.dims:
+        timescale = targets.timescale.item()
+        targets = targets.squeeze("timescale", drop=True)
+    else:
+        timescale = 1
+    return targets, timescale
+
+
+def ar1_coefficients(
+    arr: np.ndarray, firsts: np.ndarray, lasts: np.ndarray, timescale: int = 1
+) -> np.ndarray:
     """
-    Solve L x = b, via SVD least squares cutting of small singular values
-    L is an array of shape (..., M, N) and b of shape (..., M).
-    Returns x of shape (..., N)
+    Least-squares coefficients of x[t + timescale] on x[t] for every column of arr (time, ...) and every segment given by _segment_bounds, as (segment, ...). With a single regressor the coefficient is the ratio of two dot products, computed for all columns at once with einsum. Columns that are constant zero over a segment get 0.
     """
-    u, s, v = np.linalg.svd(L, full_matrices=False)
-    s_max = s.max(axis=-1, keepdims=True)
-    s_min = rcond * s_max
-    inv_s = np.zeros_like(s)
-    inv_s[s >= s_min] = 1 / s[s >= s_min]
-    x = np.einsum(
-        "...ji,...j->...i", v, inv_s * np.einsum("...ji,...j->...i", u, b.conj())
-    )
-    return np.conj(x, x)
+    arr = arr.reshape(arr.shape[0], -1)
+    starts = np.unique(firsts)
+    coefs = np.zeros((len(starts), arr.shape[1]), dtype=arr.dtype)
+    for i, first in enumerate(starts):
+        last = lasts[first] + 1
+        if last - first <= timescale:
+            continue
+        x = arr[first + timescale : last]
+        y = arr[first : last - timescale]
+        num = np.einsum("ij,ij->j", x, y)
+        den = np.einsum("ij,ij->j", x, x)
+        np.divide(num, den, out=coefs[i], where=den != 0)
+    return coefs
+
+
+def remove_ar1(
+    arr: np.ndarray, firsts: np.ndarray, lasts: np.ndarray, timescale: int = 1
+) -> np.ndarray:
+    """
+    Removes in place the lag-timescale autoregressive component of arr (time, ...) within every segment given by _segment_bounds: x[t] -= a * x[t + timescale] for all but the last timescale steps of the segment, a coming from ar1_coefficients.
+    """
+    shape = arr.shape
+    arr = arr.reshape(shape[0], -1)
+    coefs = ar1_coefficients(arr, firsts, lasts, timescale)
+    for i, first in enumerate(np.unique(firsts)):
+        last = lasts[first] + 1
+        if last - first <= timescale:
+            continue
+        arr[first : last - timescale] -= arr[first + timescale : last] * coefs[i]
+    return arr.reshape(shape)
+
+
+_AR1_RESIDUALS = {}
+_AR1_CACHE_SIZE = 4
+
+
+def ar1_residuals(
+    da: xr.DataArray, timescale: int = 1, season: str | list | None = "JJA"
+) -> xr.DataArray:
+    """
+    Season of da (time first) with its lag-timescale autoregressive component removed year by year with remove_ar1. The last _AR1_CACHE_SIZE results are cached per (field, timescale, season), the field being identified by its dask token, so that all the predictors and lags correlated against the same targets reuse them. The returned values are shared with the cache and read-only, copy them before editing in place.
+    """
+    season_key = tuple(season) if isinstance(season, list) else season
+    key = (tokenize(da), timescale, season_key)
+    if key not in _AR1_RESIDUALS:
+        if len(_AR1_RESIDUALS) >= _AR1_CACHE_SIZE:
+            _AR1_RESIDUALS.pop(next(iter(_AR1_RESIDUALS)))
+        da = extract_season(da, season).transpose("time", ...)
+        firsts, lasts = _segment_bounds(da.time.values)
+        resids = remove_ar1(np.array(da.values), firsts, lasts, timescale)
+        resids.flags.writeable = False
+        _AR1_RESIDUALS[key] = da.copy(data=resids)
+    return _AR1_RESIDUALS[key]
 
 
 def compute_r(triplet, season: str | list | None = "JJA") -> np.ndarray:
     (predictor, lag), predictor_, target_ = triplet
-    if "timescale" in target_.dims:
-        timescale = target_.timescale.item()
-    else:
-        timescale = 1
-    shape = target_.shape
-    predictors, targets = [], []
-    for year in YEARS:
-        predictor = extract_season(
-            predictor_.sel(time=predictor_.time.dt.year == year), season
-        ).values
-        predictor_resid = np.linalg.lstsq(
-            predictor[timescale:, None], predictor[:-timescale], rcond=None
-        )[0][0]
-        predictor[:-timescale] = (
-            predictor[:-timescale] - predictor[timescale:] * predictor_resid
-        )
-
-        target = extract_season(
-            target_.sel(time=target_.time.dt.year == year), season
-        ).values
-        target = target.reshape(target.shape[0], -1)
-        target_resid = stacked_lstsq(target[timescale:, None], target[:-timescale])
-        target[:-timescale] = target[:-timescale] - target[timescale:] * target_resid
-        target = target.reshape(target.shape[0], *shape[-2:])
-
-        if lag > 0:
-            predictor = predictor[lag:]
-            target = target[:-lag]
-
-        predictors.append(predictor)
-        targets.append(target)
-    predictor = np.concatenate(predictors, axis=0)
-    target = np.concatenate(targets, axis=0)
-    r = np.sum(predictor[:, None, None] * target, axis=0) / np.sqrt(
-        np.sum(predictor[:, None, None] ** 2, axis=0) * np.sum(target**2, axis=0)
+    target_, timescale = _target_timescale(target_)
+    target = ar1_residuals(target_.transpose("time", "lat", "lon"), timescale, season)
+    predictor = extract_season(predictor_, season)
+    predictor, target = xr.align(predictor, target)
+    firsts, lasts = _segment_bounds(target.time.values)
+    predictor = remove_ar1(np.array(predictor.values), firsts, lasts, timescale)
+    r = correlation_maps(
+        predictor[:, None], target.values.reshape(len(firsts), -1), lasts, [lag]
     )
+    return r.reshape(target.shape[1:])
+
+
+def correlation_maps(
+    predictors: np.ndarray,
+    targets: np.ndarray,
+    lasts: np.ndarray,
+    lags: Sequence[int],
+    block_size: int = 8192,
+) -> np.ndarray:
+    """
+    Uncentered correlations of every predictor (time, predictor) with targets (time, gridpoint) at every lag, as in compute_r, returned as (predictor, lag, gridpoint). A positive lag pairs the predictor at t + lag with the target at t, so the target leads. Lagged pairs never cross the segment ends lasts. All predictors and lags are stacked into one (time, predictor * lag) matrix with zeros where the lead leaves the segment, so that the numerators of a block of gridpoints are one matrix product, and the target norms one more against the (lag, time) validity mask.
+    """
+    n_time, n_pred = predictors.shape
+    lags = np.asarray(lags, dtype=int)
+    idx = np.arange(n_time)[:, None] + lags[None, :]
+    valid = idx <= lasts[:, None]
+    lagged = np.where(
+        valid[:, None, :], predictors[np.minimum(idx, n_time - 1)].transpose(0, 2, 1), 0.0
+    )  # (time, predictor, lag)
+    pred_norms = np.sum(lagged**2, axis=0)
+    lagged = lagged.reshape(n_time, -1)
+    mask = valid.T.astype(targets.dtype)
+    n_points = targets.shape[1]
+    r = np.empty((n_pred, len(lags), n_points), dtype=np.result_type(predictors, targets))
+    for start in range(0, n_points, block_size):
+        block = targets[:, start : start + block_size]
+        num = (lagged.T @ block).reshape(n_pred, len(lags), -1)
+        target_norms = mask @ block**2
+        r[..., start : start + block_size] = num / np.sqrt(
+            pred_norms[:, :, None] * target_norms[None, :, :]
+        )
     return r
 
 
 def compute_all_responses(
-    predictors: xr.DataArray, targets: xr.DataArray, lags: Sequence | None = None
+    predictors: xr.DataArray,
+    targets: xr.DataArray,
+    lags: Sequence | None = None,
+    season: str | list | None = "JJA",
 ) -> xr.DataArray:
     if "lag" in predictors.dims:
         if lags is None:
-            lags = predictors.lags.values
+            lags = predictors.lag.values
         predictors = predictors[dict(lag=0)].reset_coords("lag", drop=True)
     if lags is None:
         lags = [0]
+    targets, timescale = _target_timescale(targets)
     coords = {
         "predictor": predictors.predictor.values,
         "lag": lags,
@@ -454,19 +867,14 @@ def compute_all_responses(
         "lon": targets.lon.values,
     }
     shape = [len(c) for c in coords.values()]
-    corr_da = xr.DataArray(np.zeros(shape), coords=coords)
-    triplets = create_all_triplets(predictors, targets, lags)
-    with Pool(processes=N_WORKERS) as pool:
-        all_r = list(
-            tqdm(
-                pool.imap(compute_r, triplets, chunksize=1),
-                total=len(triplets),
-            )
-        )
-    # all_r = list(map(compute_r, triplets))
-    all_r = np.asarray(all_r)
-    corr_da[:] = all_r.reshape(shape)
-    return corr_da
+    targets = ar1_residuals(targets.transpose("time", "lat", "lon"), timescale, season)
+    predictors = extract_season(predictors, season).transpose("time", "predictor")
+    predictors, targets = xr.align(predictors, targets)
+    firsts, lasts = _segment_bounds(targets.time.values)
+    predictors = remove_ar1(np.array(predictors.values), firsts, lasts, timescale)
+    targets = targets.values.reshape(len(firsts), -1)
+    all_r = correlation_maps(predictors, targets, lasts, lags)
+    return xr.DataArray(all_r.reshape(shape), coords=coords)
 
 
 def compute_all_scores(y_test, y_pred, y_pred_prob) -> Mapping:
@@ -819,6 +1227,8 @@ class ExtremeExperiment(object):
         mask: xr.DataArray | Literal["land"] | None = "land",
         season: str | list | None = "JJA",
         metric: str = "jaccard",
+        linkage_method: Literal["ward", "grid", "knn"] = "ward",
+        n_neighbors: int = 20,
     ) -> None:
         self.data_handler = data_handler
         self.da = self.data_handler.da
@@ -834,7 +1244,13 @@ class ExtremeExperiment(object):
         else:
             self.season = season
         self.metric = metric
+        self.linkage_method = linkage_method
+        self.n_neighbors = n_neighbors
         self.path_suffix = f"{q}_{season}_{metric}_{self.mask_name}mask"
+        if linkage_method == "grid":
+            self.path_suffix = f"{self.path_suffix}_grid"
+        elif linkage_method == "knn":
+            self.path_suffix = f"{self.path_suffix}_knn{n_neighbors}"
         self.region = self.data_handler.get_metadata()["region"]
         self.pred_path = self.path.joinpath("predictions")
         self.pred_path.mkdir(mode=0o777, parents=True, exist_ok=True)
@@ -849,20 +1265,43 @@ class ExtremeExperiment(object):
     def compute_linkage_quantile(
         self,
     ) -> np.ndarray:
+        """
+        Linkage of the gridpoints' quantile exceedances, stored once and reused for every n_clu. "ward" runs Ward on the full condensed distance matrix, O(n^2) in gridpoints. "grid" and "knn" run sparse_average_linkage on Jaccard distances along grid neighbours or along the n_neighbors nearest neighbours, O(n) in memory.
+        """
         Z_path = f"Z_{self.path_suffix}.npy"
         Z_path = self.path.joinpath(Z_path)
         if Z_path.is_file():
             return np.load(Z_path)
         condition_function = partial(quantile_exceedence, q=self.q, dim="time")
         self.load_da()
-        distances = spatial_agglomerative_clustering(
-            self.da,
-            condition_function,
-            self.mask,
-            season=self.season,
-            metric=self.metric,
+        if self.linkage_method == "ward" and self.metric != "jaccard":
+            distances = spatial_agglomerative_clustering(
+                self.da,
+                condition_function,
+                self.mask,
+                season=self.season,
+                metric=self.metric,
+            )
+            Z = linkage(squareform(distances), method="ward")
+            np.save(Z_path, Z)
+            return Z
+        if self.metric != "jaccard":
+            raise ValueError(f"{self.linkage_method} linkage only supports the jaccard metric")
+        to_cluster_flat, mask = _exceedances_flat(
+            self.da, condition_function, self.mask, self.season
         )
-        Z = linkage(squareform(distances), method="ward")
+        bits = pack_bitsets(to_cluster_flat)
+        del to_cluster_flat
+        if self.linkage_method == "ward":
+            Z = linkage(jaccard_distances(bits), method="ward")
+        else:
+            if self.linkage_method == "grid":
+                graph = grid_to_graph(*mask.shape, mask=mask)
+                rows, cols = graph.row, graph.col
+                distances = jaccard_edge_distances(bits, rows, cols)
+            else:
+                rows, cols, distances = jaccard_knn_graph(bits, self.n_neighbors)
+            Z = sparse_average_linkage(len(bits), rows, cols, distances)
         np.save(Z_path, Z)
         return Z
 
@@ -877,7 +1316,7 @@ class ExtremeExperiment(object):
             return xr.open_dataarray(clusters_da_file)
 
         Z = self.compute_linkage_quantile()
-        clusters = cut_tree(Z, n_clusters=n_clu)[:, 0]
+        clusters = cut_linkage(Z, n_clu)
         lon, lat = feature_dims["lon"], feature_dims["lat"]
         stack_dims = {"lat_lon": ("lat", "lon")}
         if self.mask is not None:
@@ -901,6 +1340,7 @@ class ExtremeExperiment(object):
         q: float | None = None,
         simple: bool = False,
         return_folder: bool = False,
+        area_weights: bool = False,
         **kwargs,
     ):
         if q is None:
@@ -911,6 +1351,8 @@ class ExtremeExperiment(object):
             simple=simple,
             **kwargs,
         )
+        if area_weights:
+            metadata["area_weights"] = True
         thispath = self.pred_path
         thispath = find_spot(thispath, metadata)
         ofiles = [
@@ -932,34 +1374,22 @@ class ExtremeExperiment(object):
             return tuple(to_ret)
         clusters_da = self.spatial_clusters_as_da(n_clu)
 
-        targets = xr.DataArray(
-            np.zeros((len(self.da.time), n_clu)),
-            coords={"time": self.da.time.values, "region": np.arange(n_clu)},
+        targets = regional_means(
+            extract_season(self.da, self.season), clusters_da, n_clu, area_weights
         )
-        for i_clu in trange(n_clu):
-            targets.loc[:, i_clu] = (
-                self.da.where(clusters_da == i_clu)
-                .mean(["lon", "lat"])
-                .compute(**COMPUTE_KWARGS)
+        targets = targets.transpose("time", "region").compute(**COMPUTE_KWARGS)
+        if simple:
+            exceedences = quantile_exceedence(targets, q).transpose(*targets.dims)
+            length_targets = targets.copy(data=exceedences.values.astype(int))
+            all_spells = []
+            all_spells_ts = []
+        else:
+            all_spells_ts, all_spells, length_targets = spells_from_da(
+                targets,
+                q,
+                output_type="both",
+                **kwargs,
             )
-        targets = extract_season(targets, self.season)
-        length_targets = targets.copy(data=np.zeros(targets.shape, dtype=int))
-        all_spells = []
-        all_spells_ts = []
-        for i_clu in trange(n_clu):
-            targets_ = targets[:, i_clu]
-            if simple:
-                da_spells = quantile_exceedence(targets_, q)
-            else:
-                spells_ts, spells, da_spells = spells_from_da(
-                    targets_,
-                    q,
-                    output_type="both",
-                    **kwargs,
-                )
-                all_spells_ts.append(spells_ts)
-                all_spells.append(spells)
-            length_targets[:, i_clu] = da_spells
         to_ret = targets, length_targets, all_spells_ts, all_spells
         for to_save, ofile in zip(to_ret, ofiles):
             if ofile.suffix == ".nc":
@@ -982,12 +1412,8 @@ class ExtremeExperiment(object):
         targets, _, all_spells_ts, all_spells = self.create_targets(
             n_clu, i_clu, q, simple, **kwargs
         )
-        if "time_before" in kwargs:
-            new_kwargs = {"time_before": kwargs["time_before"]}
-        else:
-            new_kwargs = {}
         return mask_from_spells_multi_region(
-            timeseries, targets, all_spells_ts, all_spells, **new_kwargs
+            timeseries, targets, all_spells_ts, all_spells
         )
         
     def full_prediction(
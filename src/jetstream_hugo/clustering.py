@@ -1,15 +1,21 @@
 from typing import Sequence, Tuple, Literal, Mapping, Optional, Callable
 
 from matplotlib.pylab import norm
+import os
 import logging
+from functools import partial
+from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
+from numpy.lib.format import open_memmap
 import pandas as pd
 import xarray as xr
-from tqdm import tqdm
+from tqdm import tqdm, trange
+from dask import compute as dask_compute
 from dask.diagnostics import ProgressBar
-from dask.array import Array as DaArray, from_array
+from dask.array import Array as DaArray, from_array, nanmin, nanmax
+from dask.array.linalg import svd, svd_compressed
 import scipy.linalg as linalg
 from scipy.optimize import minimize
 
@@ -19,6 +25,9 @@ try:
 except ModuleNotFoundError:
     from sklearn.decomposition import PCA
     from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA as SkPCA, IncrementalPCA
+from sklearn.cluster import KMeans as SkKMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
 # from simpsom import SOMNet
 from xpysom_dask.xpysom import XPySom
 
@@ -28,6 +37,7 @@ from jetstream_hugo.definitions import (
     save_pickle,
     load_pickle,
     COMPUTE_KWARGS,
+    N_WORKERS,
     degcos,
     labels_to_mask,
     to_zero_one,
@@ -121,7 +131,13 @@ def labels_to_centers(
     da: xr.DataArray | xr.Dataset,
     expected_nclu: int | None = None,
     coord: str = "cluster",
-) -> xr.DataArray:
+    return_variance: bool = False,
+) -> xr.DataArray | Tuple[xr.DataArray, xr.DataArray]:
+    """
+    Means (and optionally variances) of da over the samples of each cluster, all clusters in one grouped reduction over the sample dims. Non-index coordinates along time are averaged the same way.
+    """
+    from flox.xarray import xarray_reduce
+
     if isinstance(labels, xr.DataArray):
         labels = labels.values
     if expected_nclu is not None:
@@ -133,28 +149,343 @@ def labels_to_centers(
         unique_labels, counts = np.unique(labels, return_counts=True)
     counts = counts / float(len(labels))
     dims = list(get_sample_dims(da))
-    extra_dims = [coord for coord in da.coords if coord not in da.dims]
-    centers = [
-        _compute(da.isel(time=(labels == i)).mean(dim=dims)) for i in tqdm(unique_labels)
+    extra_dims = [
+        coord_ for coord_ in da.coords if coord_ not in da.dims and "time" in da[coord_].dims
     ]
-    for extra_dim in extra_dims:
-        for i, center in enumerate(centers):
-            centers[i] = center.assign_coords(
-                {extra_dim: da[extra_dim].isel(time=(labels == i)).mean(dim=dims)}
-            )
-    centers = xr.concat(centers, dim=coord)
-    centers = centers.assign_coords(
-        {"ratio": (coord, counts), "label": (coord, unique_labels)}
-    )
-    return centers.set_xindex("label")
+    is_da = isinstance(da, xr.DataArray)
+    ds = da.to_dataset(name="__centers__") if is_da else da
+    ds = ds.reset_coords(extra_dims)
+    labels = xr.DataArray(labels, coords={"time": da.time.values}, name=coord)
+    funcs = ["nanmean", "nanvar"] if return_variance else ["nanmean"]
+    results = [
+        xarray_reduce(
+            ds,
+            labels,
+            func=func,
+            expected_groups=unique_labels,
+            dim=dims,
+            fill_value=np.nan,
+        )
+        for func in funcs
+    ]
+    results = dask_compute(*results, **COMPUTE_KWARGS)
+    to_ret = []
+    for result in results:
+        result = result.set_coords(extra_dims).drop_vars(coord).transpose(coord, ...)
+        if is_da:
+            result = result["__centers__"].rename(da.name)
+        result = result.assign_coords(
+            {"ratio": (coord, counts), "label": (coord, unique_labels)}
+        )
+        to_ret.append(result.set_xindex("label"))
+    if return_variance:
+        return tuple(to_ret)
+    return to_ret[0]
 
 
 def timeseries_on_map(timeseries: np.ndarray, labels: list | np.ndarray):
-    timeseries = np.atleast_2d(timeseries)
-    mask = labels_to_mask(labels)
-    return np.asarray(
-        [[np.nanmean(timeseries_[mas]) for mas in mask.T] for timeseries_ in timeseries]
+    timeseries = np.atleast_2d(timeseries).astype(float)
+    mask = labels_to_mask(labels).astype(float)
+    valid = ~np.isnan(timeseries)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (np.where(valid, timeseries, 0) @ mask) / (valid @ mask)
+
+
+PCA_MAX_IN_MEMORY: int = 2**31  # bytes
+PCA_MAX_TSQR_FEATURES: int = 10000
+
+
+def _row_batches(n_samples: int, batch_size: int, min_size: int) -> list[slice]:
+    bounds = list(range(0, n_samples, batch_size))
+    if len(bounds) > 1 and n_samples - bounds[-1] < min_size:
+        bounds.pop()
+    bounds.append(n_samples)
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _pca_full(X: np.ndarray | DaArray, n_pcas: int) -> Tuple[np.ndarray, ...]:
+    results = PCA(n_components=n_pcas, whiten=False).fit(X)
+    results = _compute(results, progress=True)
+    return (
+        np.asarray(results.components_),
+        np.asarray(results.mean_),
+        np.asarray(results.explained_variance_),
+    )
+
+
+def _pca_randomized(X: np.ndarray | DaArray, n_pcas: int) -> Tuple[np.ndarray, ...]:
+    if isinstance(X, DaArray):
+        mean = _compute(X.mean(axis=0), progress=True)
+        _, s, v = svd_compressed(X - mean[None, :], n_pcas, n_power_iter=4)
+        s, v = _compute(s, progress=True), _compute(v, progress=True)
+        return v, mean, s**2 / (X.shape[0] - 1)
+    results = SkPCA(n_components=n_pcas, whiten=False, svd_solver="randomized").fit(X)
+    return results.components_, results.mean_, results.explained_variance_
+
+
+def _pca_incremental(X: np.ndarray | DaArray, n_pcas: int) -> Tuple[np.ndarray, ...]:
+    batch_size = max(2 * n_pcas, 2**28 // (X.shape[1] * X.dtype.itemsize))
+    results = IncrementalPCA(n_components=n_pcas, whiten=False)
+    for batch in tqdm(_row_batches(X.shape[0], batch_size, n_pcas)):
+        results.partial_fit(_compute(X[batch]))
+    return results.components_, results.mean_, results.explained_variance_
+
+
+def _pca_tsqr(X: np.ndarray | DaArray, n_pcas: int) -> Tuple[np.ndarray, ...]:
+    if not isinstance(X, DaArray):
+        X = from_array(X)
+    X = X.rechunk({0: max(X.chunksize[0], X.shape[1]), 1: -1})
+    mean = _compute(X.mean(axis=0), progress=True)
+    _, s, v = svd(X - mean[None, :])
+    s, v = _compute(s[:n_pcas], progress=True), _compute(v[:n_pcas], progress=True)
+    return v, mean, s**2 / (X.shape[0] - 1)
+
+
+PCA_ENGINES: Mapping[str, Callable] = {
+    "full": _pca_full,
+    "randomized": _pca_randomized,
+    "incremental": _pca_incremental,
+    "tsqr": _pca_tsqr,
+}
+
+
+def choose_pca_engine(X: np.ndarray | DaArray, n_pcas: int) -> str:
+    n_samples, n_features = X.shape
+    if n_samples * n_features * X.dtype.itemsize <= PCA_MAX_IN_MEMORY:
+        return "full" if n_pcas > 0.5 * min(n_samples, n_features) else "randomized"
+    if n_features <= PCA_MAX_TSQR_FEATURES:
+        return "tsqr"
+    return "incremental"
+
+
+KMEANS_MINIBATCH_THRESHOLD: int = 200000
+_KMEANS_X: np.ndarray | None = None
+
+
+def _init_kmeans_worker(scores_file: Path, n_pcas: int) -> None:
+    global _KMEANS_X
+    _KMEANS_X = np.load(scores_file, mmap_mode="r")[:, :n_pcas]
+
+
+def _fit_one_kmeans(
+    run: Tuple[int, int],
+    engine: Literal["full", "minibatch"] = "full",
+    n_threads: int | None = None,
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    n_clu, seed = run
+    if engine == "minibatch":
+        model = MiniBatchKMeans(n_clu, random_state=seed, batch_size=4096, n_init=3)
+    else:
+        model = SkKMeans(n_clu, random_state=seed)
+    with threadpool_limits(limits=n_threads):
+        model = model.fit(_KMEANS_X)
+    return (
+        model.cluster_centers_.astype(np.float32),
+        model.labels_.astype(np.int32),
+        float(model.inertia_),
+    )
+
+
+def whiten_autocorrs(autocorrs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Whitened lagged covariances C0^-1/2 C(l) C0^-1/2, with C0^1/2 to map OPPs back.
+    """
+    C0sqrt = np.real(linalg.sqrtm(autocorrs[0]))
+    C0minushalf = linalg.inv(C0sqrt)
+    whitened = np.einsum("ij,ljk,km->lim", C0minushalf, autocorrs, C0minushalf)
+    return whitened, C0sqrt
+
+
+def _trapz_weights(n: int) -> np.ndarray:
+    weights = np.ones(n)
+    weights[[0, -1]] = 0.5
+    return weights
+
+
+def _minus_T2(
+    x: np.ndarray, whitened: np.ndarray, weights: np.ndarray
+) -> Tuple[float, np.ndarray]:
+    """
+    Minus the T2 integral of x in whitened space, and its gradient.
+    """
+    normxsq = x @ x
+    quad = np.einsum("i,lij,j->l", x, whitened, x)
+    fun = -2 * weights @ quad**2 / normxsq**2
+    grad = np.einsum("l,lij,j->i", weights * quad, whitened, x)
+    grad += np.einsum("l,lji,j->i", weights * quad, whitened, x)
+    grad = -4 * grad / normxsq**2 - 4 * fun * x / normxsq
+    return fun, grad
+
+
+def _opp_T2_start(x0: np.ndarray, whitened: np.ndarray) -> Tuple[float, np.ndarray, bool]:
+    weights = _trapz_weights(whitened.shape[0])
+    res = minimize(
+        _minus_T2,
+        x0,
+        args=(whitened, weights),
+        jac=True,
+        method="SLSQP",
+        constraints={
+            "type": "ineq",
+            "fun": lambda x: 10 - x @ x,
+            "jac": lambda x: -2 * x,
+        },
     )
+    return float(res.fun), res.x, bool(res.success)
+
+
+def solve_opps_T2(
+    autocorrs: np.ndarray,
+    n_opps: int = 10,
+    n_starts: int = 32,
+    seed: int | None = 0,
+    processes: int = N_WORKERS,
+) -> dict:
+    """
+    T2 OPPs from lagged covariances. Each OPP is the best of n_starts SLSQP runs from random starts, run on a process pool, then deflated out of the whitened tensor. Starting points all come from one generator seeded with seed, so results do not depend on the number of processes.
+    """
+    whitened, C0sqrt = whiten_autocorrs(autocorrs)
+    n_features = whitened.shape[1]
+    rng = np.random.default_rng(seed)
+    basis = linalg.orth(linalg.inv(C0sqrt))
+    xmin, xmax = np.amin(basis, axis=0), np.amax(basis, axis=0)
+    Id = np.eye(n_features)
+    OPPs = []
+    T2s = []
+    processes = max(1, min(processes, n_starts))
+    pool = Pool(processes=processes) if processes > 1 else None
+    try:
+        for _ in trange(n_opps):
+            x0s = xmin + (xmax - xmin) * rng.random((n_starts, len(xmax)))
+            func = partial(_opp_T2_start, whitened=whitened)
+            if pool is not None:
+                runs = pool.map(func, x0s, chunksize=-(-n_starts // processes))
+            else:
+                runs = list(map(func, x0s))
+            successful = [run for run in runs if run[2]]
+            if len(successful) == 0:
+                logging.warning("No T2 start converged, keeping the best iterate")
+                successful = runs
+            fun, x, _ = min(successful, key=lambda run: run[0])
+            unit_x = x / linalg.norm(x)
+            OPPs.append(C0sqrt @ unit_x)
+            T2s.append(-fun)
+            proj = Id - np.outer(unit_x, unit_x)
+            whitened = proj @ whitened @ proj
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return {
+        "T": np.asarray(T2s),
+        "OPPs": np.asarray(OPPs),
+    }
+
+
+def feature_min_max(X: np.ndarray | DaArray) -> Tuple[np.ndarray, np.ndarray]:
+    # Single pass over X, both reductions share the same graph
+    if isinstance(X, DaArray):
+        return dask_compute(nanmin(X, axis=0), nanmax(X, axis=0), **COMPUTE_KWARGS)
+    return np.nanmin(X, axis=0), np.nanmax(X, axis=0)
+
+
+def _scale_batch(
+    X: np.ndarray, Xmin: np.ndarray | None = None, Xmax: np.ndarray | None = None
+) -> np.ndarray:
+    if Xmin is not None:
+        X = (X - Xmin[None, :]) / (Xmax - Xmin)[None, :]
+    return np.nan_to_num(np.asarray(X, dtype=np.float32))
+
+
+def _som_grid_sqdist(nx: int, ny: int, PBC: bool = True) -> np.ndarray:
+    ix, iy = np.unravel_index(np.arange(nx * ny), (nx, ny))
+    dx = np.abs(ix[:, None] - ix[None, :])
+    dy = np.abs(iy[:, None] - iy[None, :])
+    if PBC:
+        dx = np.minimum(dx, nx - dx)
+        dy = np.minimum(dy, ny - dy)
+    return (dx**2 + dy**2).astype(np.float32)
+
+
+def _bmus(X: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # argmin over nodes of |x - w|^2 = |x|^2 - 2 x.w + |w|^2, |x|^2 is constant per row
+    return np.argmin(np.sum(weights**2, axis=1)[None, :] - 2 * X @ weights.T, axis=1)
+
+
+def som_bmus(
+    X: np.ndarray | DaArray,
+    weights: np.ndarray,
+    Xmin: np.ndarray | None = None,
+    Xmax: np.ndarray | None = None,
+    batch_size: int = 4096,
+) -> np.ndarray:
+    labels = np.empty(X.shape[0], dtype=int)
+    for batch in _row_batches(X.shape[0], batch_size, 1):
+        labels[batch] = _bmus(_scale_batch(_compute(X[batch]), Xmin, Xmax), weights)
+    return labels
+
+
+def train_som_streaming(
+    X: np.ndarray | DaArray,
+    nx: int,
+    ny: int,
+    n_epochs: int = 50,
+    PBC: bool = True,
+    Xmin: np.ndarray | None = None,
+    Xmax: np.ndarray | None = None,
+    batch_size: int = 4096,
+    sigma_start: float | None = None,
+    sigma_end: float = 0.5,
+    checkpoint_path: Path | None = None,
+    seed: int = 0,
+    resume: bool = True,
+) -> np.ndarray:
+    """
+    Batch SOM (Kohonen's batch map) fed with time chunks of X, so memory is bounded by batch_size rows whatever the length of X. Every epoch is one pass over X accumulating neighbourhood-weighted sums, after which the weights are replaced by the weighted means. The gaussian neighbourhood width decays geometrically from sigma_start to sigma_end. Weights, epoch and training parameters are checkpointed after every epoch. If resume, training restarts from an existing checkpoint made with the same parameters, and refuses to if they differ. The checkpoint is deleted once training is done.
+    """
+    n_nodes = nx * ny
+    grid_sqdist = _som_grid_sqdist(nx, ny, PBC)
+    if sigma_start is None:
+        sigma_start = max(nx, ny) / 2
+    config = np.asarray(
+        [nx, ny, n_epochs, PBC, batch_size, sigma_start, sigma_end, seed, *X.shape],
+        dtype=np.float64,
+    )
+    batches = _row_batches(X.shape[0], batch_size, 1)
+    if resume and checkpoint_path is not None and checkpoint_path.is_file():
+        with np.load(checkpoint_path) as checkpoint:
+            if "config" not in checkpoint or not np.array_equal(
+                checkpoint["config"], config
+            ):
+                raise ValueError(
+                    f"Checkpoint {checkpoint_path} was made with other training parameters, delete it or train with resume=False"
+                )
+            weights, start_epoch = checkpoint["weights"], int(checkpoint["epoch"])
+    else:
+        rng = np.random.default_rng(seed)
+        init_idx = np.sort(rng.choice(X.shape[0], n_nodes, replace=False))
+        weights = _scale_batch(_compute(X[init_idx]), Xmin, Xmax)
+        start_epoch = 0
+    for epoch in trange(start_epoch, n_epochs):
+        sigma = sigma_start * (sigma_end / sigma_start) ** (epoch / max(1, n_epochs - 1))
+        neighbourhood = np.exp(-grid_sqdist / (2 * sigma**2))
+        numerator = np.zeros(weights.shape, dtype=np.float64)
+        denominator = np.zeros(n_nodes, dtype=np.float64)
+        for batch in batches:
+            X_ = _scale_batch(_compute(X[batch]), Xmin, Xmax)
+            onehot = np.zeros((X_.shape[0], n_nodes), dtype=np.float32)
+            onehot[np.arange(X_.shape[0]), _bmus(X_, weights)] = 1
+            numerator += neighbourhood @ (onehot.T @ X_)
+            denominator += neighbourhood @ onehot.sum(axis=0)
+        weights = (numerator / denominator[:, None]).astype(np.float32)
+        if checkpoint_path is not None:
+            tmp_path = checkpoint_path.with_name(f".{checkpoint_path.name}")
+            with open(tmp_path, "wb") as handle:
+                np.savez(handle, weights=weights, epoch=epoch + 1, config=config)
+            os.replace(tmp_path, checkpoint_path)
+    if checkpoint_path is not None:
+        checkpoint_path.unlink(missing_ok=True)
+    return weights
 
 
 class Experiment(object):
@@ -199,47 +530,127 @@ class Experiment(object):
         X = da_weighted.data.reshape(self.data_handler.get_flat_shape())
         return X, da_weighted
 
-    def _pca_file(self, n_pcas: int) -> str | None:
-        potential_paths = list(self.path.glob("pca_*.pkl"))
+    def _pca_paths(self, n_pcas: int) -> Mapping[str, Path]:
+        return {
+            key: self.path.joinpath(f"pca_{n_pcas}_{key}.npy")
+            for key in ["components", "mean", "variance"]
+        }
+
+    def _pca_from_pickle(self, pkl_path: Path) -> Path:
+        # Older runs pickled the fitted model, turn it into mappable arrays once
+        results = load_pickle(pkl_path)
+        n_pcas = int(pkl_path.stem.split("_")[1])
+        arrays = {
+            "components": results.components_,
+            "mean": results.mean_,
+            "variance": results.explained_variance_,
+        }
+        paths = self._pca_paths(n_pcas)
+        for key, path in paths.items():
+            np.save(path, np.asarray(arrays[key]))
+        return paths["components"]
+
+    def _pca_file(self, n_pcas: int) -> Path | None:
         potential_paths = {
-            path: int(path.stem.split("_")[1]) for path in potential_paths
+            path: int(path.stem.split("_")[1])
+            for path in self.path.glob("pca_*_components.npy")
         }
-        for key, value in potential_paths.items():
-            if value >= n_pcas:
-                return key
-        return None
+        for path in self.path.glob("pca_*.pkl"):
+            if self._pca_paths(int(path.stem.split("_")[1]))["components"].is_file():
+                continue
+            potential_paths[self._pca_from_pickle(path)] = int(path.stem.split("_")[1])
+        potential_paths = {
+            path: value for path, value in potential_paths.items() if value >= n_pcas
+        }
+        if len(potential_paths) == 0:
+            return None
+        return min(potential_paths, key=potential_paths.get)
 
-    def compute_pcas(self, n_pcas: int, force: bool = False) -> str:
+    def compute_pcas(
+        self,
+        n_pcas: int,
+        force: bool = False,
+        engine: Literal["auto", "full", "randomized", "incremental", "tsqr"] = "auto",
+    ) -> Path:
         path = self._pca_file(n_pcas)
         if path is not None and not force:
             return path
-        logging.debug(f"Computing {n_pcas} pcas")
         X, _ = self.prepare_for_clustering()
-        pca_path = self.path.joinpath(f"pca_{n_pcas}.pkl")
-        results = PCA(n_components=n_pcas, whiten=False).fit(X)
-        results = _compute(results, progress=True)
-        save_pickle(results, pca_path)
-        return pca_path
+        if engine == "auto":
+            engine = choose_pca_engine(X, n_pcas)
+        logging.debug(f"Computing {n_pcas} pcas with the {engine} engine")
+        components, mean, variance = PCA_ENGINES[engine](X, n_pcas)
+        paths = self._pca_paths(n_pcas)
+        np.save(paths["components"], components.astype(np.float32))
+        np.save(paths["mean"], mean.astype(np.float32))
+        np.save(paths["variance"], variance)
+        self._clear_pca_scores()
+        return paths["components"]
+
+    def load_pcas(self, n_pcas: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Memory-mapped components (at least n_pcas of them) and the feature mean
+        """
+        pca_path = self.compute_pcas(n_pcas)
+        components = np.load(pca_path, mmap_mode="r")
+        mean = np.load(pca_path.with_name(pca_path.name.replace("components", "mean")))
+        return components, mean
+
+    def _score_files(self) -> Mapping[Path, int]:
+        potential_paths = {}
+        for path in self.path.glob("pca_*.npy"):
+            parts = path.stem.split("_")
+            if len(parts) == 2:
+                potential_paths[path] = int(parts[1])
+        return potential_paths
+
+    def _clear_pca_scores(self) -> None:
+        # scores and their lagged covariances are projections on the previous components
+        for path in self._score_files():
+            path.unlink(missing_ok=True)
+        self._clear_pca_autocorrs()
+
+    def _scores_file(self, n_pcas: int) -> Path | None:
+        potential_paths = {
+            path: value
+            for path, value in self._score_files().items()
+            if value >= n_pcas
+        }
+        if len(potential_paths) == 0:
+            return None
+        return min(potential_paths, key=potential_paths.get)
 
     def pca_transform(
         self,
         X: np.ndarray | DaArray,
         n_pcas: int | None = None,
-        compute: bool = False,
+        compute: bool = True,
     ) -> np.ndarray:
+        """
+        PC scores of X. Unless compute is False, they are written to pca_{n_pcas}.npy in time chunks and returned memory-mapped. Any stored score file with at least n_pcas columns is sliced instead of recomputing.
+        """
         if n_pcas is None:
             return X
-        transformed_file = self.path.joinpath(f"pca_{n_pcas}.npy")
-        if transformed_file.is_file():
-            return np.load(transformed_file)
-        pca_path = self.compute_pcas(n_pcas)
-        pca_results = load_pickle(pca_path)
-        X = pca_results.transform(X)[:, :n_pcas]
+        scores_file = self._scores_file(n_pcas)
+        if scores_file is not None:
+            return np.load(scores_file, mmap_mode="r")[:, :n_pcas]
+        components, mean = self.load_pcas(n_pcas)
+        components = np.asarray(components[:n_pcas]).T
         if not compute:
-            return X
-        X = _compute(X, progress=True)
-        np.save(transformed_file, X)
-        return X
+            return (X - mean[None, :]) @ components
+        scores_file = self.path.joinpath(f"pca_{n_pcas}.npy")
+        tmp_file = self.path.joinpath(f".pca_{n_pcas}.npy.part")
+        scores = open_memmap(
+            tmp_file, mode="w+", dtype=np.float32, shape=(X.shape[0], n_pcas)
+        )
+        batch_size = max(1, 2**28 // (X.shape[1] * X.dtype.itemsize))
+        for batch in tqdm(_row_batches(X.shape[0], batch_size, 1)):
+            scores[batch] = _compute((X[batch] - mean[None, :]) @ components)
+        scores.flush()
+        del scores
+        os.replace(tmp_file, scores_file)
+        self._clear_pca_autocorrs()
+        return np.load(scores_file, mmap_mode="r")
 
     def pca_inverse_transform(
         self,
@@ -249,11 +660,8 @@ class Experiment(object):
     ) -> np.ndarray:
         if n_pcas is None:
             return X
-        pca_path = self.compute_pcas(n_pcas)
-        pca_results = load_pickle(pca_path)
-        diff_n_pcas = pca_results.n_components - X.shape[1]
-        X = np.pad(X, [[0, 0], [0, diff_n_pcas]])
-        X = pca_results.inverse_transform(X)
+        components, mean = self.load_pcas(n_pcas)
+        X = X @ np.asarray(components[: X.shape[1]]) + mean[None, :]
         if not compute:
             return X
         return _compute(X, progress=True)
@@ -319,26 +727,107 @@ class Experiment(object):
         labels = self.labels_as_da(labels)
         return centers, labels
 
+    def _kmeans_results_file(self, n_pcas: int, engine: str) -> Path:
+        return self.path.joinpath(f"kmeans_{n_pcas}_{engine}.npz")
+
+    def load_kmeans_results(self, n_pcas: int, engine: str) -> dict:
+        results_file = self._kmeans_results_file(n_pcas, engine)
+        if not results_file.is_file():
+            return {}
+        with np.load(results_file) as results:
+            return dict(results)
+
+    def kmeans_sweep(
+        self,
+        n_clus: Sequence[int],
+        n_pcas: int,
+        seeds: Sequence[int] = (0,),
+        engine: Literal["auto", "full", "minibatch"] = "auto",
+        processes: int = N_WORKERS,
+    ) -> dict:
+        """
+        Fits one k-means per (n_clu, seed) pair that is not stored yet. Workers memory-map the same PC score file, so X lives once in memory. All runs of an engine are kept in kmeans_{n_pcas}_{engine}.npz: n_clu, seed, inertia, labels (run, sample) and centers (run, max n_clu, pc), NaN-padded.
+        """
+        X, _ = self.prepare_for_clustering()
+        X = self.pca_transform(X, n_pcas)
+        scores_file = self._scores_file(n_pcas)
+        if engine == "auto":
+            engine = "minibatch" if X.shape[0] > KMEANS_MINIBATCH_THRESHOLD else "full"
+        results = self.load_kmeans_results(n_pcas, engine)
+        done = set(zip(results.get("n_clu", []), results.get("seed", [])))
+        runs = [
+            (n_clu, seed)
+            for n_clu in n_clus
+            for seed in seeds
+            if (n_clu, seed) not in done
+        ]
+        if len(runs) == 0:
+            return results
+        logging.debug(f"Fitting {len(runs)} {engine} KMeans clusterings")
+        processes = min(processes, len(runs))
+        func = partial(
+            _fit_one_kmeans, engine=engine, n_threads=1 if processes > 1 else None
+        )
+        if processes > 1:
+            with Pool(
+                processes=processes,
+                initializer=_init_kmeans_worker,
+                initargs=(scores_file, n_pcas),
+            ) as pool:
+                new_results = list(tqdm(pool.imap(func, runs), total=len(runs)))
+        else:
+            _init_kmeans_worker(scores_file, n_pcas)
+            new_results = list(map(func, runs))
+        all_centers = [
+            center[:n_clu]
+            for center, n_clu in zip(
+                results.get("centers", []), results.get("n_clu", [])
+            )
+        ]
+        all_centers.extend([new_result[0] for new_result in new_results])
+        max_clu = max([len(center) for center in all_centers])
+        centers = np.full((len(all_centers), max_clu, n_pcas), np.nan, dtype=np.float32)
+        for i, center in enumerate(all_centers):
+            centers[i, : len(center)] = center
+        results = {
+            "n_clu": np.append(results.get("n_clu", []), [run[0] for run in runs]).astype(int),
+            "seed": np.append(results.get("seed", []), [run[1] for run in runs]).astype(int),
+            "inertia": np.append(
+                results.get("inertia", []), [new_result[2] for new_result in new_results]
+            ),
+            "labels": np.concatenate(
+                [
+                    results.get("labels", np.zeros((0, X.shape[0]), dtype=np.int32)),
+                    [new_result[1] for new_result in new_results],
+                ]
+            ),
+            "centers": centers,
+        }
+        np.savez(self._kmeans_results_file(n_pcas, engine), **results)
+        return results
+
     def do_kmeans(
         self,
         n_clu: int,
         n_pcas: int,
         return_type: int = RAW_REALSPACE,
+        seed: int = 0,
+        engine: Literal["auto", "full", "minibatch"] = "auto",
     ) -> str | Tuple[xr.DataArray, xr.DataArray, str]:
         X, _ = self.prepare_for_clustering()
         X = self.pca_transform(X, n_pcas)
-        results = KMeans(n_clu)
 
         results_path = self.path.joinpath(f"k_{n_clu}_{n_pcas}.pkl")
         if results_path.is_file():
             results = load_pickle(results_path)
-        else:
-            logging.debug(f"Fitting KMeans clustering with {n_clu} clusters")
-            results = results.fit(X)
-            save_pickle(results, results_path)
+            centers = results.cluster_centers_
+            labels = results.labels_
+            return self._cluster_output(centers, labels, return_type, X)
 
-        centers = results.cluster_centers_
-        labels = results.labels_
+        results = self.kmeans_sweep([n_clu], n_pcas, [seed], engine, processes=1)
+        i_run = np.flatnonzero((results["n_clu"] == n_clu) & (results["seed"] == seed))[0]
+        centers = results["centers"][i_run, :n_clu]
+        labels = results["labels"][i_run]
 
         return self._cluster_output(centers, labels, return_type, X)
 
@@ -352,8 +841,14 @@ class Experiment(object):
         return_type: int = RAW_REALSPACE,
         force: bool = False,
         train_kwargs: dict | None = None,
+        streaming: bool = False,
         **kwargs,
     ) -> Tuple[XPySom, xr.DataArray, np.ndarray]:
+        """
+        With streaming=True, the map is trained out-of-core by train_som_streaming on the full-resolution field (no coarsening), train_kwargs going to it instead of XPySom.train. Only the euclidean metric is supported in that mode.
+        """
+        if streaming and metric != "euclidean":
+            raise ValueError("Streaming SOM training only supports the euclidean metric")
         pbc_flag = "_pbc" if PBC else ""
         init = "random" if self.data_handler.get_flat_shape()[1] > 5000 else "pca"
         net = XPySom(
@@ -368,6 +863,8 @@ class Experiment(object):
             output_file_stem = f"som_{nx}_{ny}{pbc_flag}_{n_pcas}"
         else:
             output_file_stem = f"som_{nx}_{ny}{pbc_flag}_{metric}"
+        if streaming:
+            output_file_stem = f"{output_file_stem}_stream"
         output_path_weights = self.path.joinpath(f"{output_file_stem}.npy")
         output_path_centers = self.path.joinpath(f"centers_{output_file_stem}.nc")
         output_path_labels = self.path.joinpath(f"labels_{output_file_stem}.nc")
@@ -379,6 +876,20 @@ class Experiment(object):
             return net, centers, labels
         if train_kwargs is None:
             train_kwargs = {}
+        if streaming:
+            return self._som_cluster_streaming(
+                net,
+                nx,
+                ny,
+                n_pcas,
+                PBC,
+                return_type,
+                output_path_weights,
+                output_path_centers,
+                output_path_labels,
+                train_kwargs,
+                force,
+            )
         train_kwargs["out_path"] = output_path_weights
         X, da_weighted = self.prepare_for_clustering()
         if n_pcas:
@@ -400,49 +911,97 @@ class Experiment(object):
         centers.to_netcdf(output_path_centers)
         labels.to_netcdf(output_path_labels)
         return net, centers, labels
-    
+
+    def _som_cluster_streaming(
+        self,
+        net: XPySom,
+        nx: int,
+        ny: int,
+        n_pcas: int,
+        PBC: bool,
+        return_type: int,
+        output_path_weights: Path,
+        output_path_centers: Path,
+        output_path_labels: Path,
+        train_kwargs: dict,
+        force: bool = False,
+    ) -> Tuple[XPySom, xr.DataArray, np.ndarray]:
+        X, _ = self.prepare_for_clustering()
+        if n_pcas:
+            X = self.pca_transform(X, n_pcas)
+            Xmin, Xmax = None, None
+        else:
+            Xmin, Xmax = feature_min_max(X)
+        checkpoint_path = output_path_weights.with_suffix(".ckpt.npz")
+        weights = train_som_streaming(
+            X,
+            nx,
+            ny,
+            PBC=PBC,
+            Xmin=Xmin,
+            Xmax=Xmax,
+            checkpoint_path=checkpoint_path,
+            **(train_kwargs | {"resume": not force and train_kwargs.get("resume", True)}),
+        )
+        np.save(output_path_weights, weights)
+        net.load_weights(output_path_weights)
+        labels = som_bmus(X, weights, Xmin, Xmax)
+        net.latest_bmus = labels
+        if not n_pcas:
+            weights = revert_zero_one(weights, Xmin, Xmax)
+
+        centers, labels = self._cluster_output(weights, labels, return_type, X)
+        centers.to_netcdf(output_path_centers)
+        labels.to_netcdf(output_path_labels)
+        return net, centers, labels
+
     def project_on_other_som(
         self,
-        other_exp: Path,  
+        other_exp: "Experiment",
+        batch_size: int = 4096,
         **kwargs,
     ) -> Tuple[XPySom, xr.DataArray, np.ndarray]:
+        """
+        Labels of this experiment's samples on the SOM that other_exp.som_cluster(**kwargs) trains or loads. The field is interpolated on the other grid lazily, then mapped to PC space with the other experiment's components or scaled to [0, 1] (statistics from one pre-pass), and best-matching units are found block by block against the SOM weights.
+        """
         nx, ny = kwargs["nx"], kwargs["ny"]
-        pbc = "pbc" in kwargs and kwargs["pbc"]
+        pbc = kwargs.get("PBC", True)
         pbc_flag = "_pbc" if pbc else ""
+        streaming = kwargs.get("streaming", False)
+        n_pcas = kwargs.get("n_pcas", 0)
         net, centers, labels = other_exp.som_cluster(**kwargs)
-        
-        if "n_pcas" in kwargs and kwargs["n_pcas"]:
-            n_pcas = kwargs["n_pcas"]
-            output_file = f"othersom_labels_{nx}_{ny}{pbc_flag}_{n_pcas}.nc"
+
+        if n_pcas:
+            output_file = f"othersom_labels_{nx}_{ny}{pbc_flag}_{n_pcas}"
         else:
-            metric = kwargs["metric"]
-            output_file = f"othersom_labels_{nx}_{ny}{pbc_flag}_{metric}.nc"
-        output_file = self.path.joinpath(output_file)
+            metric = kwargs.get("metric", "euclidean")
+            output_file = f"othersom_labels_{nx}_{ny}{pbc_flag}_{metric}"
+        if streaming:
+            output_file = f"{output_file}_stream"
+        output_file = self.path.joinpath(f"{output_file}.nc")
         if output_file.is_file():
             return net, centers, xr.open_dataarray(output_file)
         other_da = other_exp.da
         _, da_weighted = self.prepare_for_clustering()
-                
-        if "n_pcas" in kwargs and kwargs["n_pcas"]:
-            X = self.pca_transform(X, kwargs["n_pcas"])
+
+        if not n_pcas and not streaming and (other_da.lon[1] - other_da.lon[0]).item() < 1:
+            other_da = coarsen_da(other_da, 1.5)
+        da_weighted = da_weighted.chunk({"time": batch_size}).interp(
+            lon=other_da.lon.values,
+            lat=other_da.lat.values,
+            kwargs={"fill_value": "extrapolate"},
+        )
+        X = da_weighted.data.reshape(self.data_handler.get_flat_shape()[0], -1)
+        if n_pcas:
+            components, mean = other_exp.load_pcas(n_pcas)
+            X = (X - mean[None, :]) @ np.asarray(components[:n_pcas]).T
+            Xmin, Xmax = None, None
         else:
-            if (other_da.lon[1] - other_da.lon[0]).item() < 1:
-                other_da = coarsen_da(other_da, 1.5)
-            da_weighted = da_weighted.interp(
-                lon=other_da.lon.values, 
-                lat=other_da.lat.values,
-                kwargs={"fill_value": "extrapolate"}
-            )
-            X = to_zero_one(
-                da_weighted.data.reshape(
-                    np.prod(da_weighted.shape[:2]), 
-                    np.prod(da_weighted.shape[2:])
-                )
-            )[0]
-        
+            Xmin, Xmax = feature_min_max(X)
+        weights = np.asarray(net.weights).reshape(-1, X.shape[1])
+
         sample_shape = [len(co) for co in self.data_handler.sample_dims.values()]
-        X = _compute(X, progress=True)
-        labels = net.predict(X).reshape(sample_shape)
+        labels = som_bmus(X, weights, Xmin, Xmax, batch_size).reshape(sample_shape)
         labels = xr.DataArray(labels, coords=self.data_handler.sample_dims)
         labels.attrs["som_from_exp"] = other_exp.path.as_posix()
         for key, val in kwargs.items():
@@ -454,13 +1013,33 @@ class Experiment(object):
         labels.to_netcdf(output_file)
         return net, centers, labels
 
+    def get_autocorrs(
+        self, X: np.ndarray, lag_max: int, from_pcas: bool = False
+    ) -> np.ndarray:
+        """
+        Lagged covariances of X (see stats.compute_autocorrs), stored as autocorrs_{source}_{n_features}_{lag_max}.npy, source being "pca" if X are PC scores and "raw" otherwise. A stored file with more lags is sliced. PC files are cleared whenever PCA components or scores are rewritten.
+        """
+        n_features = X.shape[1]
+        stem = f"autocorrs_{'pca' if from_pcas else 'raw'}_{n_features}"
+        for path in self.path.glob(f"{stem}_*.npy"):
+            if int(path.stem.split("_")[3]) >= lag_max:
+                return np.load(path)[:lag_max]
+        autocorrs = compute_autocorrs(X, lag_max)
+        np.save(self.path.joinpath(f"{stem}_{lag_max}.npy"), autocorrs)
+        return autocorrs
+
+    def _clear_pca_autocorrs(self) -> None:
+        for path in self.path.glob("autocorrs_pca_*.npy"):
+            path.unlink(missing_ok=True)
+
     # TODO maybe: OPPs are untested with Dask input
     def _compute_opps_T1(
         self,
         X: np.ndarray,
         lag_max: int,
+        from_pcas: bool = False,
     ) -> dict:
-        autocorrs = compute_autocorrs(X, lag_max)
+        autocorrs = self.get_autocorrs(X, lag_max, from_pcas)
         M = np.trapz(autocorrs + autocorrs.transpose((0, 2, 1)), axis=0)
 
         invC0 = linalg.inv(autocorrs[0])
@@ -485,59 +1064,19 @@ class Experiment(object):
             "OPPs": OPPs,
         }
 
-    def _compute_opps_T2(self, X: np.ndarray, lag_max: int) -> dict:
-        autocorrs = compute_autocorrs(X, lag_max)
-        C0sqrt = linalg.sqrtm(autocorrs[0])
-        C0minushalf = linalg.inv(C0sqrt)
-        basis = linalg.orth(C0minushalf)
-
-        def minus_T2(x) -> float:
-            normxsq = linalg.norm(x) ** 2
-            factor1 = x.T @ C0minushalf @ autocorrs @ C0minushalf @ x
-            return -2 * np.trapz(factor1**2) / normxsq**2
-
-        def minus_T2_gradient(x) -> np.ndarray:
-            normxsq = linalg.norm(x) ** 2
-            factor1 = x.T @ C0minushalf @ autocorrs @ C0minushalf @ x
-            factor2 = (
-                C0minushalf @ (autocorrs + autocorrs.transpose((0, 2, 1))) @ C0minushalf
-            ) @ x
-            numerator = 4 * np.trapz(factor1[:, None] * factor2, axis=0)
-            return -numerator / normxsq**2 - 4 * minus_T2(x) * x / normxsq**3
-
-        def norm0(x) -> float:
-            return 10 - linalg.norm(x) ** 2
-
-        def jac_norm0(x) -> np.ndarray:
-            return -2 * x
-
-        Id = np.eye(X.shape[1])
-        proj = Id.copy()
-        OPPs = []
-        T2s = []
-        numsuc = 0
-        while numsuc < 10:
-            xmin, xmax = np.amin(basis, axis=0), np.amax(basis, axis=0)
-            x0 = xmin + (xmax - xmin) * np.random.rand(len(xmax))
-            res = minimize(
-                minus_T2,
-                x0,
-                jac=minus_T2_gradient,
-                method="SLSQP",
-                constraints={"type": "ineq", "fun": norm0, "jac": jac_norm0},
-            )
-            if res.success:
-                unit_x = res.x / linalg.norm(res.x)
-                OPPs.append(C0sqrt @ unit_x)
-                T2s.append(-res.fun)
-                proj = Id - np.outer(unit_x, unit_x)
-                autocorrs = proj @ autocorrs @ proj
-                C0minushalf = proj @ C0minushalf @ proj
-                numsuc += 1
-        return {
-            "T": np.asarray(T2s),
-            "OPPs": np.asarray(OPPs),
-        }
+    def _compute_opps_T2(
+        self,
+        X: np.ndarray,
+        lag_max: int,
+        n_starts: int = 32,
+        seed: int | None = 0,
+        processes: int = N_WORKERS,
+        from_pcas: bool = False,
+    ) -> dict:
+        autocorrs = self.get_autocorrs(X, lag_max, from_pcas)
+        return solve_opps_T2(
+            autocorrs, n_starts=n_starts, seed=seed, processes=processes
+        )
 
     def compute_opps(
         self,
@@ -545,10 +1084,14 @@ class Experiment(object):
         lag_max: int = 90,
         type_: int = 1,
         return_realspace: bool = False,
+        n_starts: int = 32,
+        seed: int | None = 0,
+        processes: int = N_WORKERS,
     ) -> Tuple[Path, dict]:
         if type_ not in [1, 2]:
             raise ValueError(f"Wrong OPP type, pick 1 or 2")
         X, _ = self.prepare_for_clustering()
+        from_pcas = bool(n_pcas)
         if n_pcas:
             X = self.pca_transform(X, n_pcas)
         X = X.reshape((X.shape[0], -1))
@@ -558,10 +1101,17 @@ class Experiment(object):
         if not opp_path.is_file():
             if type_ == 1:
                 logging.debug("Computing T1 OPPs")
-                results = self._compute_opps_T1(X, lag_max)
+                results = self._compute_opps_T1(X, lag_max, from_pcas)
             if type_ == 2:
                 logging.debug("Computing T2 OPPs")
-                results = self._compute_opps_T2(X, lag_max)
+                results = self._compute_opps_T2(
+                    X,
+                    lag_max,
+                    n_starts=n_starts,
+                    seed=seed,
+                    processes=processes,
+                    from_pcas=from_pcas,
+                )
             save_pickle(results, opp_path)
         if results is None:
             results = load_pickle(opp_path)
@@ -1,5 +1,11 @@
+import os
+import json
+import fcntl
 import warnings
 from os.path import commonpath
+from functools import lru_cache
+from contextlib import contextmanager
+from hashlib import sha256
 
 from typing import Union, Optional, Mapping, Sequence, Tuple, Literal
 from itertools import product
@@ -43,15 +49,89 @@ def get_land_mask() -> xr.DataArray:
     return mask.astype(bool)
 
 
-def determine_file_structure(path: Path) -> str:
+FILE_INDEX = "file_index.json"
+
+
+def _write_json_atomic(filename: Path, obj: Mapping) -> None:
+    tmp_path = filename.with_name(f".{filename.name}.{os.getpid()}")
+    try:
+        with open(tmp_path, "w") as handle:
+            json.dump(obj, handle, indent=0, sort_keys=True)
+        os.replace(tmp_path, filename)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _index_entry(filename: Path) -> dict:
+    entry = {"mtime": filename.stat().st_mtime}
+    with xr.open_dataset(filename, chunks=None) as ds:
+        entry["sizes"] = {dim: int(size) for dim, size in ds.sizes.items()}
+        if "time" in ds.coords:
+            times = ds.indexes["time"]
+            entry["start"] = str(pd.Timestamp(str(times[0])))
+            entry["end"] = str(pd.Timestamp(str(times[-1])))
+    return entry
+
+
+def _data_files(path: Path) -> list[Path]:
+    # full.nc if present, else the yearly files, else the monthly files
     if path.joinpath("full.nc").is_file():
-        return "one_file"
-    if any([path.joinpath(f"{year}.nc").is_file() for year in YEARS]):
-        return "yearly"
-    if any([path.joinpath(f"{year}01.nc").is_file() for year in YEARS]):
-        return "monthly"
-    print("Could not determine file structure")
-    raise RuntimeError
+        return [path.joinpath("full.nc")]
+    filenames = [fn for fn in path.iterdir() if fn.suffix == ".nc" and fn.stem.isdigit()]
+    for n_digits in (4, 6):
+        structure = [fn for fn in filenames if len(fn.stem) == n_digits]
+        if len(structure) > 0:
+            return structure
+    return []
+
+
+def get_file_index(path: Path) -> dict:
+    """
+    Per-file time range and sizes of the data files in path (full.nc, else yearly, else monthly files), cached in a json sidecar. Entries are refreshed when a file's mtime changes, so only new or rewritten files get opened. If the sidecar cannot be written, the index is only kept in memory.
+    """
+    index_path = path.joinpath(FILE_INDEX)
+    try:
+        with open(index_path, "r") as handle:
+            index = json.load(handle)
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    filenames = _data_files(path)
+    changed = len(index) != len(filenames)
+    new_index = {}
+    for fn in filenames:
+        entry = index.get(fn.name)
+        if entry is None or entry["mtime"] != fn.stat().st_mtime:
+            entry = _index_entry(fn)
+            changed = True
+        new_index[fn.name] = entry
+    if changed:
+        try:
+            _write_json_atomic(index_path, new_index)
+        except OSError:
+            pass
+    return new_index
+
+
+def files_from_index(
+    path: Path,
+    file_index: Mapping,
+    period: Sequence[int],
+    monthlist: Sequence[int] | None = None,
+) -> list[Path]:
+    period = np.atleast_1d(period)
+    files_to_load = {}
+    for filename, entry in file_index.items():
+        if "start" not in entry:
+            files_to_load[filename] = pd.Timestamp.min
+            continue
+        months = pd.period_range(entry["start"], entry["end"], freq="M")
+        overlap = np.isin(months.year, period)
+        if monthlist is not None:
+            overlap = overlap & np.isin(months.month, monthlist)
+        if np.any(overlap):
+            files_to_load[filename] = pd.Timestamp(entry["start"])
+    files_to_load = sorted(files_to_load, key=files_to_load.get)
+    return [path.joinpath(filename) for filename in files_to_load]
 
 
 def data_path(
@@ -172,18 +252,21 @@ def extract_levels(da: xr.DataArray, levels: int | str | list | tuple | Literal[
             return da.reset_coords("lev", drop=True)
         return da
 
-    newcoords = {dim: da.coords[dim] for dim in ["time", "lat", "lon"]}
-    if "lev" in da.coords:
-        newcoords = newcoords | {"lev": level_names}
-    shape = [len(coord) for coord in newcoords.values()]
-    da2 = xr.DataArray(np.zeros(shape), coords=newcoords)
-    for level, level_name in zip(levels, level_names):
+    # (lev, layer) indicator matrix, layer means become one lazy contraction over lev
+    indicator = np.zeros((len(da.lev), len(levels)), dtype=da.dtype)
+    for j, level in enumerate(levels):
         if isinstance(level, tuple):
-            val = da.sel(lev=level).mean(dim="lev").values
-        else:
-            val = da.sel(lev=level).values
-        da2.loc[:, :, :, level_name] = val
-
+            level = list(level)
+        indicator[:, j] = np.isin(da.lev.values, np.atleast_1d(da.lev.sel(lev=level).values))
+    indicator = xr.DataArray(
+        indicator, coords={"lev": da.lev.values, "layer": level_names}
+    )
+    valid = da.notnull()
+    da2 = xr.dot(da.where(valid, 0), indicator, dim="lev") / xr.dot(
+        valid.astype(da.dtype), indicator, dim="lev"
+    )
+    da2 = da2.rename(layer="lev").transpose(..., "lev").rename(da.name)
+    da2.attrs = da.attrs
     return da2.squeeze()
 
 
@@ -215,7 +298,15 @@ def _open_dataarray(filename: Path | list[Path], varname: str) -> xr.DataArray:
     if isinstance(filename, list) and len(filename) == 1:
         filename = filename[0]
     if isinstance(filename, list):
-        da = xr.open_mfdataset(filename, chunks=None)
+        da = xr.open_mfdataset(
+            filename,
+            chunks=None,
+            combine="nested",
+            concat_dim="time",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        )
         da = da.unify_chunks()
     else:
         da = xr.open_dataset(filename, chunks="auto")
@@ -297,8 +388,6 @@ def open_da(
         smoothing,
         False,
     )
-    file_structure = determine_file_structure(path)
-
     if isinstance(period, tuple):
         period = np.arange(int(period[0]), int(period[1] + 1))
     elif isinstance(period, list):
@@ -308,38 +397,24 @@ def open_da(
     elif isinstance(period, int | str):
         period = [int(period)]
 
-    files_to_load = []
-
-    if file_structure == "one_file":
-        files_to_load = [path.joinpath("full.nc")]
-    elif file_structure == "yearly":
-        files_to_load = [path.joinpath(f"{year}.nc") for year in period]
-    elif file_structure == "monthly":
-        if season is None:
-            files_to_load = [
-                path.joinpath(f"{year}{str(month).zfill(2)}.nc")
-                for month in range(1, 13)
-                for year in period
-            ]
-        else:
-            if isinstance(season, str):
-                monthlist = SEASONS[season]
-            elif isinstance(season, list):
-                monthlist = np.atleast_1d(season)
-            elif isinstance(season, tuple):
-                sample_tr = TIMERANGE[TIMERANGE.year == period[0]]
-                monthlist = np.unique(
-                    sample_tr[
-                        np.isin(sample_tr.dayofyear, np.arange(season[0], season[1]))
-                    ].month
-                )
-            files_to_load = [
-                path.joinpath(f"{year}{str(month).zfill(2)}.nc")
-                for month in monthlist
-                for year in period
-            ]
-
-    files_to_load = [fn for fn in files_to_load if fn.is_file()]
+    monthlist = None
+    if isinstance(season, str):
+        monthlist = SEASONS[season]
+    elif isinstance(season, list):
+        monthlist = np.atleast_1d(season)
+    elif isinstance(season, tuple):
+        sample_tr = TIMERANGE[TIMERANGE.year == period[0]]
+        monthlist = np.unique(
+            sample_tr[
+                np.isin(sample_tr.dayofyear, np.arange(season[0], season[1]))
+            ].month
+        )
+
+    file_index = get_file_index(path)
+    if len(file_index) == 0:
+        print("Could not determine file structure")
+        raise RuntimeError
+    files_to_load = files_from_index(path, file_index, period, monthlist)
 
     da = _open_dataarray(files_to_load, varname)
     da = extract(
@@ -399,12 +474,65 @@ def _window_smoothing(
     return xr.concat(to_concat, dim=dim).sortby(dim)
 
 
+def _strided_hourofyear(hourofyear: np.ndarray) -> int | None:
+    # Number of hours per day if hourofyear reshapes cleanly into (day, hour), None otherwise
+    n_hours = len(np.unique(hourofyear % 24))
+    if len(hourofyear) % n_hours != 0 or np.any(np.diff(hourofyear) <= 0):
+        return None
+    hours = (hourofyear % 24).reshape(-1, n_hours)
+    if np.any(hours != hours[:1]):
+        return None
+    return n_hours
+
+
+def _cyclic_rolling_mean(
+    arr: np.ndarray, n_hours: int, winsize: int, center: bool = True
+) -> np.ndarray:
+    # arr has hourofyear as last axis. Rolling nanmean along days for each hour, with min_periods=1
+    shape = arr.shape
+    arr = arr.reshape(*shape[:-1], -1, n_hours)
+    n_days = arr.shape[-2]
+    before = winsize // 2 if center else winsize - 1
+    after = winsize - 1 - before
+    arr = np.take(arr, np.arange(-before, n_days + after) % n_days, axis=-2)
+    valid = np.isfinite(arr)
+    pad = [(0, 0)] * (arr.ndim - 2) + [(1, 0), (0, 0)]
+    sums = np.pad(np.cumsum(np.where(valid, arr, 0), axis=-2, dtype=np.float64), pad)
+    counts = np.pad(np.cumsum(valid, axis=-2), pad)
+    sums = sums[..., winsize:, :] - sums[..., :-winsize, :]
+    counts = counts[..., winsize:, :] - counts[..., :-winsize, :]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.where(counts > 0, sums / counts, np.nan)
+    return out.astype(arr.dtype).reshape(shape)
+
+
+def _hourofyear_smoothing(
+    da: xr.DataArray | xr.Dataset, n_hours: int, winsize: int, center: bool = True
+) -> xr.DataArray | xr.Dataset:
+    # Same window in days as the groupby path applied to the wrap-padded array
+    winsize = max(1, (int(np.ceil(winsize / 2)) // n_hours) // 4)
+    return xr.apply_ufunc(
+        _cyclic_rolling_mean,
+        da,
+        kwargs={"n_hours": n_hours, "winsize": winsize, "center": center},
+        input_core_dims=[["hourofyear"]],
+        output_core_dims=[["hourofyear"]],
+        dask="parallelized",
+        keep_attrs=True,
+    ).transpose(*da.dims)
+
+
 def window_smoothing(
     da: xr.DataArray, dim: str, winsize: int, center: bool = True
 ) -> xr.DataArray:
     dims = dim.split("+")
     for dim in dims:
-        if pad_wrap(da, dim):
+        n_hours = None
+        if dim == "hourofyear" and dim in da.dims:
+            n_hours = _strided_hourofyear(da.hourofyear.values)
+        if n_hours is not None:
+            newda = _hourofyear_smoothing(da, n_hours, winsize, center)
+        elif pad_wrap(da, dim):
             halfwinsize = int(np.ceil(winsize / 2))
             da = da.pad({dim: halfwinsize}, mode="wrap")
             newda = _window_smoothing(da, dim, halfwinsize, center)
@@ -444,18 +572,107 @@ def fft_smoothing(da: xr.DataArray, dim: str, winsize: int) -> xr.DataArray:
     return newda
 
 
-def spharm_smoothing(da: xr.DataArray, trunc: int):
-    raise NotImplementedError("Broken for now")
-    # spharmt = Spharmt(len(da.lon), len(da.lat))
-    # fieldspec = spharmt.grdtospec(da.values, ntrunc=trunc)
-    # fieldtrunc = spharmt.spectogrd(fieldspec)
-    # return fieldtrunc
+def _legendre_functions(x: np.ndarray, trunc: int) -> np.ndarray:
+    # Fully normalized associated Legendre functions, shape (m, n, len(x)), zero for n < m
+    plm = np.zeros((trunc + 1, trunc + 1, len(x)))
+    sinth = np.sqrt(1 - x**2)
+    pmm = np.full(len(x), np.sqrt(0.5))
+    for m in range(trunc + 1):
+        if m > 0:
+            pmm = np.sqrt((2 * m + 1) / (2 * m)) * sinth * pmm
+        plm[m, m] = pmm
+        if m == trunc:
+            break
+        plm[m, m + 1] = np.sqrt(2 * m + 3) * x * pmm
+        for n in range(m + 2, trunc + 1):
+            a_nm = np.sqrt((4 * n**2 - 1) / (n**2 - m**2))
+            a_nm_prev = np.sqrt((4 * (n - 1) ** 2 - 1) / ((n - 1) ** 2 - m**2))
+            plm[m, n] = a_nm * (x * plm[m, n - 1] - plm[m, n - 2] / a_nm_prev)
+    return plm
+
+
+def _latitude_weights(lat: np.ndarray) -> np.ndarray:
+    bounds = np.concatenate(
+        [
+            [1.5 * lat[0] - 0.5 * lat[1]],
+            0.5 * (lat[1:] + lat[:-1]),
+            [1.5 * lat[-1] - 0.5 * lat[-2]],
+        ]
+    )
+    bounds = np.clip(bounds, -90, 90)
+    return np.abs(np.diff(np.sin(np.deg2rad(bounds))))
+
+
+@lru_cache(maxsize=16)
+def _spharm_filter(lat: tuple, nlon: int, trunc: int) -> np.ndarray:
+    """
+    Builds, for every zonal wavenumber m <= trunc, the (lat, lat) matrix that projects a Fourier coefficient profile onto the span of the P_n^m, n <= trunc. The projection is a weighted least-squares fit, which reduces to the usual quadrature on a global grid but stays well defined on regular or regional latitude grids.
+    """
+    lat = np.asarray(lat)
+    mmax = min(trunc, nlon // 2)
+    plm = _legendre_functions(np.sin(np.deg2rad(lat)), trunc)
+    sqrt_w = np.sqrt(_latitude_weights(lat))
+    filters = np.zeros((mmax + 1, len(lat), len(lat)))
+    for m in range(mmax + 1):
+        basis = plm[m, m:].T
+        filters[m] = basis @ np.linalg.pinv(sqrt_w[:, None] * basis, rcond=1e-10) * sqrt_w[None, :]
+    return filters
+
+
+def _spharm_truncate(
+    field: np.ndarray, filters: np.ndarray, batch_size: int = 512
+) -> np.ndarray:
+    shape = field.shape
+    field = field.reshape(-1, *shape[-2:])
+    mmax = filters.shape[0]
+    out = np.empty(field.shape, dtype=field.dtype)
+    for start in range(0, field.shape[0], batch_size):
+        end = min(start + batch_size, field.shape[0])
+        ft = np.fft.rfft(field[start:end], axis=-1)
+        # (m, lat, batch) layout with real and imaginary parts interleaved: one real GEMM per m
+        ft_m = np.ascontiguousarray(ft[..., :mmax].transpose(2, 1, 0))
+        ft_m = filters @ ft_m.view(ft_m.real.dtype)
+        ft[..., :mmax] = ft_m.view(np.complex128).transpose(2, 1, 0)
+        ft[..., mmax:] = 0
+        out[start:end] = np.fft.irfft(ft, n=shape[-1], axis=-1)
+    return out.reshape(shape)
+
+
+def spharm_smoothing(
+    da: xr.DataArray | xr.Dataset, trunc: int
+) -> xr.DataArray | xr.Dataset:
+    if isinstance(da, xr.Dataset):
+        return da.map(
+            lambda var: spharm_smoothing(var, trunc)
+            if {"lat", "lon"} <= set(var.dims)
+            else var
+        )
+    lon = da.lon.values
+    dlon = lon[1] - lon[0]
+    if not np.isclose(len(lon) * dlon, 360):
+        raise ValueError(
+            "Spherical harmonic truncation needs a global, regularly spaced longitude"
+        )
+    filters = _spharm_filter(tuple(da.lat.values.tolist()), len(lon), int(trunc))
+    da = da.where(~da.isnull(), 0)
+    newda = xr.apply_ufunc(
+        _spharm_truncate,
+        da,
+        kwargs={"filters": filters},
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[["lat", "lon"]],
+        dask="parallelized",
+        output_dtypes=[da.dtype],
+        dask_gufunc_kwargs={"allow_rechunk": True},
+        keep_attrs=True,
+    )
+    return newda.transpose(*da.dims)
 
 
 def smooth(
     da: xr.DataArray | xr.Dataset,
     smooth_map: Mapping | None,
-) -> xr.DataArray:
+) -> xr.DataArray | xr.Dataset:
     import xrft
     if smooth_map is None:
         return da
@@ -665,30 +882,123 @@ def _fix_dict_lists(dic: dict) -> dict:
             dic[key] = val.tolist()
     return dic
 
-def find_spot(basepath: Path, metadata: Mapping) -> Path:
-    found = False
-    metadata = _fix_dict_lists(metadata)
-    for dir in basepath.iterdir():
-        if not dir.is_dir():
-            continue
+METADATA_INDEX = "metadata_index.json"
+
+
+def _canonical_repr(obj) -> str:
+    if isinstance(obj, Mapping):
+        items = sorted(
+            f"{_canonical_repr(key)}:{_canonical_repr(val)}" for key, val in obj.items()
+        )
+        return "{" + ",".join(items) + "}"
+    if isinstance(obj, np.ndarray):
+        obj = obj.tolist()
+    if isinstance(obj, list):
+        return "[" + ",".join(_canonical_repr(val) for val in obj) + "]"
+    if isinstance(obj, tuple):
+        return "(" + ",".join(_canonical_repr(val) for val in obj) + ")"
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, bool | int) or (isinstance(obj, float) and obj.is_integer()):
+        # 1, 1.0, True and their numpy counterparts compare equal, so they must hash equal
+        return repr(int(obj))
+    return repr(obj)
+
+
+def metadata_hash(metadata: Mapping) -> str:
+    return sha256(_canonical_repr(metadata).encode()).hexdigest()
+
+
+@contextmanager
+def _metadata_index_lock(basepath: Path):
+    # POSIX record lock, unlike flock it is honoured by NFS and Lustre
+    with open(basepath.joinpath(f".{METADATA_INDEX}.lock"), "w") as handle:
+        fcntl.lockf(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(handle, fcntl.LOCK_UN)
+
+
+def _read_metadata_index(basepath: Path) -> dict | None:
+    try:
+        with open(basepath.joinpath(METADATA_INDEX), "r") as handle:
+            return json.load(handle)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _index_folders(dirs: Sequence[Path]) -> dict:
+    index = {}
+    for dir in dirs:
         try:
             other_mda = _fix_dict_lists(load_pickle(dir.joinpath("metadata.pkl")))
             if "varnames" in other_mda:
                 other_mda["varnames"].sort()
         except FileNotFoundError:
             continue
-        if metadata == other_mda:
-            newpath = basepath.joinpath(dir.name)
-            found = True
-            break
-
-    if not found:
-        seq = [int(dir.name) for dir in basepath.iterdir() if dir.is_dir()]
+        index[metadata_hash(other_mda)] = dir.name
+    return index
+
+
+def _index_hit(basepath: Path, index: Mapping | None, key: str) -> Path | None:
+    if index is None or key not in index:
+        return None
+    path = basepath.joinpath(index[key])
+    if not path.joinpath("metadata.pkl").is_file():
+        return None
+    return path
+
+
+def rebuild_metadata_index(basepath: Path) -> dict:
+    """
+    Recreates the hash -> folder name index of basepath from the metadata.pkl of every subfolder. Not locked, find_spot calls it with the lock held; call it by hand only when nothing else is writing to basepath.
+    """
+    index = _index_folders([dir for dir in basepath.iterdir() if dir.is_dir()])
+    _write_json_atomic(basepath.joinpath(METADATA_INDEX), index)
+    return index
+
+
+def _create_spot(basepath: Path, metadata: Mapping, key: str) -> Path:
+    # with the lock held: re-read the index, unpickle only the folders it does not know, then create the folder if still missing
+    index = _read_metadata_index(basepath)
+    path = _index_hit(basepath, index, key)
+    if path is not None:
+        return path
+    dirs = [dir for dir in basepath.iterdir() if dir.is_dir()]
+    if index is None or key in index:  # missing or stale index
+        index = {}
+    known = set(index.values())
+    index |= _index_folders([dir for dir in dirs if dir.name not in known])
+    path = _index_hit(basepath, index, key)
+    if path is None:
+        seq = [int(dir.name) for dir in dirs]
         id = max(seq) + 1 if len(seq) != 0 else 1
-        newpath = basepath.joinpath(str(id))
-        newpath.mkdir()
-        save_pickle(metadata, newpath.joinpath("metadata.pkl"))
-    return newpath
+        path = basepath.joinpath(str(id))
+        path.mkdir()
+        save_pickle(metadata, path.joinpath("metadata.pkl"))
+        index[key] = path.name
+    _write_json_atomic(basepath.joinpath(METADATA_INDEX), index)
+    return path
+
+
+def find_spot(basepath: Path, metadata: Mapping) -> Path:
+    """
+    Result folder of basepath whose metadata.pkl holds metadata, created if there is none. Hits are read from the index without locking, so read-only trees work. Misses take the lock and only unpickle the folders the index does not know yet, e.g. created by older runs or copied in.
+    """
+    metadata = _fix_dict_lists(metadata)
+    key = metadata_hash(metadata)
+    path = _index_hit(basepath, _read_metadata_index(basepath), key)
+    if path is not None:
+        return path
+    if not os.access(basepath, os.W_OK):
+        index = _index_folders([dir for dir in basepath.iterdir() if dir.is_dir()])
+        path = _index_hit(basepath, index, key)
+        if path is None:
+            raise PermissionError(f"No results for this metadata in read-only {basepath}")
+        return path
+    with _metadata_index_lock(basepath):
+        return _create_spot(basepath, metadata, key)
 
 
 def flatten_by(ds: xr.Dataset, by: str = "-criterion") -> xr.Dataset:
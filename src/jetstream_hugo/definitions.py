@@ -2,7 +2,7 @@ import os
 import platform
 import pickle as pkl
 from pathlib import Path
-from typing import Any, Callable, ClassVar, Dict, Optional
+from typing import Any, Callable, ClassVar, Dict, Optional, Tuple
 from itertools import groupby
 from dataclasses import dataclass, field
 import time
@@ -356,6 +356,66 @@ def get_runs_fill_holes(mask, cyclic: bool = True, hole_size: int = 8):
     return indices
 
 
+def _runs_nd(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # start, inclusive end and column of every run of True in the columns of a (time, n) mask, sorted by column then start
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1]), dtype=np.int8)
+    padded[1:-1] = mask
+    diff = np.diff(padded, axis=0).T
+    column, start = np.nonzero(diff == 1)
+    _, end = np.nonzero(diff == -1)
+    return start, end - 1, column
+
+
+def _first_run_lengths(start, end, column, n_columns: int) -> np.ndarray:
+    first_lengths = np.zeros(n_columns, dtype=int)
+    at_zero = start == 0
+    first_lengths[column[at_zero]] = end[at_zero] + 1
+    return first_lengths
+
+
+def get_runs_fill_holes_nd(
+    mask: np.ndarray, cyclic: bool = True, hole_size: int = 8, min_length: int = 11
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    get_runs_fill_holes for every column of a (time, n) mask at once. Holes of at most hole_size are filled with the same rules, then runs of at least min_length are kept, or the longest run of a column if it has none. Returns start, inclusive end and column of the kept runs, sorted by column then start. Runs wrapping around the end of a cyclic mask are dropped instead of returned as wrapped indices.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim == 1:
+        mask = mask[:, None]
+    n_time, n_columns = mask.shape
+    if hole_size > 0:
+        start, end, column = _runs_nd(~mask)
+        length = end - start + 1
+        if cyclic:
+            skip = (start == 0) & ~mask[-1, column]
+            wraps = (end == n_time - 1) & (start > 0) & ~mask[0, column]
+            first_lengths = _first_run_lengths(start, end, column, n_columns)
+            length = length + np.where(wraps, first_lengths[column], 0)
+        else:
+            skip = (start == 0) | (end == n_time - 1)
+        fill = (length <= hole_size) & ~skip
+        filled = np.zeros((n_time + 1, n_columns), dtype=int)
+        np.add.at(filled, (start[fill], column[fill]), 1)
+        np.add.at(filled, (end[fill] + 1, column[fill]), -1)
+        mask = mask | (np.cumsum(filled, axis=0)[:-1] > 0)
+    start, end, column = _runs_nd(mask)
+    length = end - start + 1
+    wraps = np.zeros(len(start), dtype=bool)
+    if cyclic:
+        wraps = (end == n_time - 1) & (start > 0) & mask[0, column]
+        first_lengths = _first_run_lengths(start, end, column, n_columns)
+        length = length + np.where(wraps, first_lengths[column], 0)
+    keep = length >= min_length
+    has_run = np.zeros(n_columns, dtype=bool)
+    has_run[column[keep]] = True
+    order = np.lexsort((start, -length, column))
+    _, first = np.unique(column[order], return_index=True)
+    longest = order[first]
+    keep[longest[~has_run[column[longest]]]] = True
+    keep &= ~wraps
+    return start[keep], end[keep], column[keep]
+
+
 def _compute(obj, progress: bool = False, **kwargs):
     kwargs = COMPUTE_KWARGS | kwargs
     try:
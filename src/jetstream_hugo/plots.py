@@ -1,5 +1,5 @@
 from itertools import product
-from typing import Any, Mapping, Sequence, Tuple, Union, Iterable
+from typing import Any, Literal, Mapping, Sequence, Tuple, Union, Iterable
 
 import numpy as np
 from scipy.stats import gaussian_kde
@@ -42,7 +42,11 @@ from jetstream_hugo.definitions import (
     PRETTIER_VARNAME,
     infer_direction,
 )
-from jetstream_hugo.stats import field_significance, field_significance_v2
+from jetstream_hugo.stats import (
+    field_significance,
+    field_significance_v2,
+    SignificancePool,
+)
 
 TEXTWIDTH_IN = 0.0138889 * 503.61377
 
@@ -658,6 +662,7 @@ class Clusterplot:
         FDR: bool = True,
         color: str | list = "black",
         hatch: str = "..",
+        method: Literal["normal", "cumsum", "searchsorted"] = "normal",
     ) -> None:
         to_test = []
         for mas in mask.T:
@@ -670,11 +675,15 @@ class Clusterplot:
         lat = da.lat.values
         significances = []
         da = da.values
-        # da = np.sort(da, axis=0)
-        for i in trange(mask.shape[1]):
-            significances.append(
-                field_significance(to_test[i], da, 100, q=0.01)[int(FDR)]
-            )
+        if method == "normal":
+            for i in trange(mask.shape[1]):
+                significances.append(
+                    field_significance(to_test[i], da, 100, q=0.01)[int(FDR)]
+                )
+        else:
+            with SignificancePool(da, method=method) as pool:
+                for i in trange(mask.shape[1]):
+                    significances.append(pool.test(to_test[i], 100, q=0.01)[int(FDR)])
 
         for ax, signif in zip(self.axes, significances):
             cs = ax.contourf(
@@ -1,71 +1,198 @@
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Literal
 from functools import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 import pickle as pkl
 
 import numpy as np
 import pandas as pd
 import xarray as xr
-from scipy.stats import norm
+from scipy.fft import rfft, irfft, next_fast_len
+from scipy.sparse import csr_matrix
+from scipy.stats import norm, kstwo
 from jetstream_hugo.definitions import N_WORKERS, infer_direction
 
 
+def _autocorrelation_fft(arr: np.ndarray, lag_max: int) -> np.ndarray:
+    # Pearson correlation of arr[..., :-i] with arr[..., i:] for every lag i, like xr.corr on shifted copies. The lagged cross sums come from one zero-padded FFT along time, the segment sums and sums of squares from cumsums
+    n_time = arr.shape[-1]
+    arr = arr - np.mean(arr, axis=-1, keepdims=True)
+    lags = np.arange(lag_max)
+    n = n_time - lags
+    nfft = next_fast_len(n_time + lag_max, real=True)
+    ft = rfft(arr, n=nfft, axis=-1)
+    cross = irfft(ft.real**2 + ft.imag**2, n=nfft, axis=-1)[..., :lag_max]
+    zeros = np.zeros((*arr.shape[:-1], 1))
+    sums = np.concatenate([zeros, np.cumsum(arr, axis=-1)], axis=-1)
+    squares = np.concatenate([zeros, np.cumsum(arr**2, axis=-1)], axis=-1)
+    sum_early, sum_late = sums[..., n], sums[..., -1:] - sums[..., lags]
+    sq_early, sq_late = squares[..., n], squares[..., -1:] - squares[..., lags]
+    cov = cross - sum_early * sum_late / n
+    var_early = sq_early - sum_early**2 / n
+    var_late = sq_late - sum_late**2 / n
+    return cov / np.sqrt(var_early * var_late)
+
+
+def autocorrelation_fft(
+    da: xr.DataArray, lag_max: int = 50, dim: str = "time"
+) -> xr.DataArray:
+    """
+    Autocorrelation of da along dim for all lags below lag_max at every other point, in one FFT pass. Dask-backed input is processed chunk by chunk over the other dimensions. Series containing NaNs give NaN.
+    """
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+    autocorrs = xr.apply_ufunc(
+        _autocorrelation_fft,
+        da,
+        input_core_dims=[[dim]],
+        output_core_dims=[["lag"]],
+        kwargs={"lag_max": lag_max},
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs={"output_sizes": {"lag": lag_max}},
+    )
+    autocorrs = autocorrs.assign_coords(lag=np.arange(lag_max))
+    return autocorrs.transpose("lag", ...)
+
+
 def autocorrelation(path: Path, time_steps: int = 50) -> Path:
-    ds = xr.open_dataset(path)
+    ds = xr.open_dataset(path, chunks={})
+    ds = ds.chunk({dim: -1 if dim == "time" else "auto" for dim in ds.dims})
     name = path.parts[-1].split(".")[0]
     parent = path.parent
     autocorrs = {}
-    for i, varname in enumerate(ds):
-        if varname.split("_")[-1] == "climatology":
+    for varname in ds.data_vars:
+        if varname.split("_")[-1] == "climatology" or "time" not in ds[varname].dims:
             continue
-        autocorrs[varname] = ("lag", np.empty(time_steps))
-        for j in range(time_steps):
-            autocorrs[varname][1][j] = xr.corr(
-                ds[varname], ds[varname].shift(time=j)
-            ).values
-    autocorrsda = xr.Dataset(autocorrs, coords={"lag": np.arange(time_steps)})
+        autocorrs[varname] = autocorrelation_fft(ds[varname], time_steps)
+    autocorrsda = xr.Dataset(autocorrs)
+    encoding = {
+        varname: {"chunksizes": tuple(chunks[0] for chunks in autocorrsda[varname].chunks)}
+        for varname in autocorrsda.data_vars
+    }
     opath = parent.joinpath(f"{name}_autocorrs.nc")
-    autocorrsda.to_netcdf(opath)
+    autocorrsda.to_netcdf(opath, encoding=encoding)
     return opath  # a great swedish metal bEnd
 
 
+def _lagged_means(X: np.ndarray, lag_max: int) -> Tuple[np.ndarray, ...]:
+    # means of X[:n_time - i] and of X[i:] for every lag i, from one cumsum
+    n_time, n_features = X.shape
+    lags = np.arange(lag_max)
+    n = n_time - lags
+    cumsum = np.concatenate([np.zeros((1, n_features)), np.cumsum(X, axis=0)])
+    mean_early = cumsum[n] / n[:, None]
+    mean_late = (cumsum[-1][None, :] - cumsum[lags]) / n[:, None]
+    return n, mean_early, mean_late
+
+
+def _autocorrs_direct(X: np.ndarray, lag_max: int) -> np.ndarray:
+    n_time, n_features = X.shape
+    n, mean_early, mean_late = _lagged_means(X, lag_max)
+    autocorrs = np.empty((lag_max, n_features, n_features))
+    for i in range(lag_max):
+        autocorrs[i] = X[: n_time - i].T @ X[i:]
+    return (
+        autocorrs - n[:, None, None] * mean_early[:, :, None] * mean_late[:, None, :]
+    ) / (n - 1)[:, None, None]
+
+
+def _autocorrs_fft(
+    X: np.ndarray, lag_max: int, batch_size: int | None = None
+) -> np.ndarray:
+    n_time, n_features = X.shape
+    n, mean_early, mean_late = _lagged_means(X, lag_max)
+    nfft = next_fast_len(n_time + lag_max, real=True)
+    ft = rfft(X, n=nfft, axis=0)
+    if batch_size is None:
+        batch_size = max(1, 2**28 // (ft.shape[0] * n_features * ft.itemsize))
+    autocorrs = np.empty((lag_max, n_features, n_features))
+    for start in range(0, n_features, batch_size):
+        end = min(start + batch_size, n_features)
+        cross = irfft(np.conj(ft[:, start:end, None]) * ft[:, None, :], n=nfft, axis=0)
+        autocorrs[:, start:end] = (
+            cross[:lag_max]
+            - n[:, None, None] * mean_early[:, start:end, None] * mean_late[:, None, :]
+        ) / (n - 1)[:, None, None]
+    return autocorrs
+
+
 def compute_autocorrs(
-    X: np.ndarray, lag_max: int
+    X: np.ndarray,
+    lag_max: int,
+    method: Literal["auto", "fft", "direct"] = "auto",
+    batch_size: int | None = None,
 ) -> np.ndarray:
-    autocorrs = []
-    i_max = X.shape[1]
-    for i in range(lag_max):
-        autocorrs.append(
-            np.cov(X[i:], np.roll(X, i, axis=0)[i:], rowvar=False)[i_max:, :i_max]
+    """
+    Lagged covariances autocorrs[i, p, q] = cov(X[t - i, p], X[t, q]) for i < lag_max, equal to np.cov on rolled copies of X. "direct" does one (n_features, n_features) GEMM per lag on views of X, "fft" gets all lags from one zero-padded FFT along time, forming the cross-spectra batch_size rows p at a time (~256 MB per batch by default). The FFT only pays off for long lags, "auto" uses it when lag_max exceeds ~20 log2 of the FFT length.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    X = X - X.mean(axis=0)[None, :]
+    if method == "auto":
+        nfft = next_fast_len(X.shape[0] + lag_max, real=True)
+        method = "fft" if lag_max > 20 * np.log2(nfft) else "direct"
+    if method == "fft":
+        return _autocorrs_fft(X, lag_max, batch_size)
+    return _autocorrs_direct(X, lag_max)
+
+
+def rescaled_ranges(arr: np.ndarray, subdivs: int = 11) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rescaled ranges R/S of arr (..., time) over 2**k equal chunks for k < subdivs, averaged over the chunks of each level. Each level is one reshape into (..., n_chunks, length) blocks, batched over all leading dimensions.
+    """
+    n_time = arr.shape[-1]
+    lengths = n_time // 2 ** np.arange(subdivs)
+    ranges = np.empty((*arr.shape[:-1], subdivs))
+    for k, length in enumerate(lengths):
+        n_chunks = 2**k
+        blocks = arr[..., : n_chunks * length].reshape(
+            *arr.shape[:-1], n_chunks, length
         )
-    return np.asarray(autocorrs)
+        anomalies = blocks - blocks.mean(axis=-1, keepdims=True)
+        raw_ranges = np.ptp(np.cumsum(anomalies, axis=-1), axis=-1)
+        ranges[..., k] = np.mean(raw_ranges / anomalies.std(axis=-1), axis=-1)
+    return lengths, ranges
+
+
+def _hurst_fit(arr: np.ndarray, subdivs: int = 11) -> Tuple[np.ndarray, np.ndarray]:
+    # least squares fit of log(R/S) against log(length), in closed form so it runs over all leading dimensions at once
+    lengths, ranges = rescaled_ranges(arr, subdivs)
+    x = np.log(lengths)
+    x = x - x.mean()
+    y = np.log(ranges)
+    slope = y @ x / (x @ x)
+    intercept = y.mean(axis=-1) - slope * np.log(lengths).mean()
+    return slope, np.exp(intercept)
+
+
+def hurst_exponent(
+    da: xr.DataArray, subdivs: int = 11, dim: str = "time"
+) -> xr.Dataset:
+    """
+    Hurst exponent and prefactor of the R/S law at every point of da's non-time dimensions. Dask-backed input is processed chunk by chunk over space.
+    """
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+    hurst, prefactor = xr.apply_ufunc(
+        _hurst_fit,
+        da,
+        input_core_dims=[[dim]],
+        output_core_dims=[[], []],
+        kwargs={"subdivs": subdivs},
+        dask="parallelized",
+        output_dtypes=[np.float64, np.float64],
+    )
+    return xr.Dataset({"hurst": hurst, "prefactor": prefactor})
 
 
 def Hurst_exponent(path: Path, subdivs: int = 11) -> Path:
     ds = xr.open_dataset(path)
-    subdivs = [2**n for n in range(11)]
-    lengths = [len(ds.time) // n for n in subdivs]
-    all_lengths = np.repeat(lengths, subdivs)
-    N_chunks = np.sum(subdivs)
     Hurst = {}
-    for i, varname in enumerate(ds.data_vars):
-        adjusted_ranges = []
-        for n_chunks, n in zip(subdivs, lengths):
-            start = 0
-            aranges = []
-            for k in range(n_chunks):
-                end = start + n
-                series = ds[varname].isel(time=np.arange(start, end)).values
-                mean = np.mean(series)
-                std = np.std(series)
-                series -= mean
-                series = np.cumsum(series)
-                raw_range = series.max() - series.min()
-                aranges.append(raw_range / std)
-            adjusted_ranges.append(np.mean(aranges))
-        coeffs = np.polyfit(np.log(lengths), np.log(adjusted_ranges), deg=1)
-        Hurst[varname] = [coeffs[0], np.exp(coeffs[1])]
+    for varname in ds.data_vars:
+        results = hurst_exponent(ds[varname], subdivs).compute()
+        Hurst[varname] = [results["hurst"].values, results["prefactor"].values]
+        if results["hurst"].ndim == 0:
+            Hurst[varname] = [float(val) for val in Hurst[varname]]
     parent = path.parent
     name = path.parts[-1].split(".")[0]
     opath = parent.joinpath(f"{name}_Hurst.pkl")
@@ -107,25 +234,46 @@ def fdr_correction(p: np.ndarray, q: float = 0.02):
     return fdrcorr.reshape(pshape)
 
 
+def _bootstrap_weights(
+    indices: np.ndarray, n_time: int, chunksize: int = 500
+) -> csr_matrix:
+    # row (chunk, sel) averages take_from over indices[sel, chunk]: the chunk means the old loop took with np.take, 500 samples at a time
+    n_sel, n_sam = indices.shape
+    starts = np.arange(0, n_sam, chunksize)
+    chunk = np.arange(n_sam) // chunksize
+    sizes = np.minimum(starts + chunksize, n_sam) - starts
+    rows = chunk[None, :] * n_sel + np.arange(n_sel)[:, None]
+    data = np.broadcast_to(1 / sizes[chunk], indices.shape)
+    return csr_matrix(
+        (data.ravel(), (rows.ravel(), indices.ravel())),
+        shape=(len(starts) * n_sel, n_time),
+    )
+
+
 def field_significance(
     to_test: xr.DataArray,
     take_from: np.ndarray | xr.DataArray,
     n_sel: int = 100,
     q: float = 0.02,
+    engine: Literal["auto", "dense", "sparse"] = "auto",
+    float32: bool = False,
 ) -> Tuple[xr.DataArray, xr.DataArray]:
+    """
+    Bootstrapped means of n_sel random subsets of take_from, fitted by a normal distribution to get p-values of to_test's mean. All resample means come from one product of a (n_sel, n_time) selection matrix with the flattened take_from, sparse when the subsets are small compared to n_time (below 5% by default), dense otherwise. float32 halves the memory at the cost of precision, otherwise take_from's precision is kept.
+    """
     n_sam = to_test.shape[0]
-    indices = np.random.rand(n_sel, take_from.shape[0]).argpartition(n_sam, axis=1)[
-        :, :n_sam
-    ]
+    n_time = take_from.shape[0]
+    indices = np.random.rand(n_sel, n_time).argpartition(n_sam, axis=1)[:, :n_sam]
     if isinstance(take_from, xr.DataArray):
         take_from = take_from.values
-    empirical_distribution = []
-    cs = 500
-    for ns in range(0, n_sam, cs):
-        end = min(ns + cs, n_sam)
-        empirical_distribution.append(
-            np.mean(np.take(take_from, indices[:, ns:end], axis=0), axis=1)
-        )
+    dtype = np.float32 if float32 else np.result_type(take_from.dtype, np.float32)
+    take_from = take_from.reshape(n_time, -1).astype(dtype, copy=False)
+    weights = _bootstrap_weights(indices, n_time).astype(dtype)
+    if engine == "dense" or (engine == "auto" and n_sam > 0.05 * n_time):
+        weights = weights.toarray()
+    empirical_distribution = np.asarray(weights @ take_from).reshape(
+        -1, n_sel, *to_test.shape[1:]
+    )
     direction = infer_direction(empirical_distribution)
     empirical_distribution = np.mean(empirical_distribution, axis=0)
     q = q / 2 if direction == 0 else q
@@ -151,19 +299,168 @@ def one_ks_cumsum(b: np.ndarray, a: np.ndarray, q: float = 0.02, n_sam: int = No
     return nocorr, fdr_correction(p, q)
 
 
+def ks_2samp_nd(
+    a: np.ndarray,
+    b: np.ndarray,
+    presorted: bool = False,
+    batch_size: int = 4096,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Two-sample KS statistic D and its asymptotic p-value (as scipy.stats.ks_2samp with method="asymp") at every gridpoint of a (n_a, ...) and b (n_b, ...), batch_size gridpoints at a time. With presorted samples the stable argsort of [a, b] is a linear-time merge of two runs. D is only read at the last value of each group of ties, and the p-value is evaluated once per distinct D.
+    """
+    if not presorted:
+        a = np.sort(a, axis=0)
+        b = np.sort(b, axis=0)
+    n_a, n_b = len(a), len(b)
+    grid_shape = a.shape[1:]
+    a = a.reshape(n_a, -1)
+    b = b.reshape(n_b, -1)
+    # D in units of 1 / (n_a n_b), exact integers
+    d = np.empty(a.shape[1], dtype=np.int64)
+    for start in range(0, a.shape[1], batch_size):
+        end = min(start + batch_size, a.shape[1])
+        pooled = np.concatenate([a[:, start:end], b[:, start:end]], axis=0)
+        order = np.argsort(pooled, axis=0, kind="stable")
+        pooled = np.take_along_axis(pooled, order, axis=0)
+        from_a = order < n_a
+        diff = np.cumsum(from_a, axis=0) * n_b - np.cumsum(~from_a, axis=0) * n_a
+        diff = np.abs(diff)
+        diff[:-1][pooled[1:] == pooled[:-1]] = 0
+        d[start:end] = np.amax(diff, axis=0)
+    en = n_a * n_b / (n_a + n_b)
+    d_unique, inverse = np.unique(d, return_inverse=True)
+    d = d / (n_a * n_b)
+    p = np.clip(kstwo.sf(d_unique / (n_a * n_b), np.round(en)), 0, 1)[inverse]
+    return d.reshape(grid_shape), p.reshape(grid_shape)
+
+
 def one_ks_searchsorted(b: np.ndarray, a: np.ndarray, q: float = 0.02, n_sam: int = None):
-    if n_sam is None:
-        n_sam = len(a)
-    x = np.concatenate([a, b], axis=0)
-    idxs_ks = np.argsort(x, axis=0)
-    y1 = np.cumsum(idxs_ks < n_sam, axis=0) / n_sam
-    y2 = np.cumsum(idxs_ks >= n_sam, axis=0) / n_sam
-    d = np.amax(np.abs(y1 - y2), axis=0)
-    p = np.exp(-(d**2) * n_sam)
+    # a and b must be sorted along time, see SignificancePool. Unlike one_ks_cumsum, ties are handled and p-values are the proper asymptotic ones
+    _, p = ks_2samp_nd(a, b, presorted=True)
     nocorr = (p < q).astype(int)
     return nocorr, fdr_correction(p, q)
 
 
+_SIGNIF_SHM: shared_memory.SharedMemory | None = None
+_SIGNIF_TAKE_FROM: np.ndarray | None = None
+
+
+def _init_significance_worker(shm_name: str, shape: tuple, dtype: str) -> None:
+    # only ever run in the pool workers, the parent never touches these globals
+    global _SIGNIF_SHM, _SIGNIF_TAKE_FROM
+    _SIGNIF_SHM = shared_memory.SharedMemory(name=shm_name)
+    _SIGNIF_TAKE_FROM = np.ndarray(shape, dtype=dtype, buffer=_SIGNIF_SHM.buf)
+
+
+def _significance_batch(
+    task: Tuple[np.random.SeedSequence, int],
+    a: np.ndarray,
+    q: float,
+    method: Literal["cumsum", "searchsorted"],
+    take_from: np.ndarray | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # take_from is passed in the single-process case and read from the worker's shared memory otherwise
+    if take_from is None:
+        take_from = _SIGNIF_TAKE_FROM
+    seed, n_resamples = task
+    rng = np.random.default_rng(seed)
+    n_sam = len(a)
+    n_time = take_from.shape[0]
+    func = one_ks_searchsorted if method == "searchsorted" else one_ks_cumsum
+    nocorr = np.zeros(take_from.shape[1:], dtype=int)
+    fdrcorr = np.zeros(take_from.shape[1:], dtype=int)
+    for _ in range(n_resamples):
+        indices = rng.choice(n_time, n_sam, replace=False)
+        if method == "searchsorted":
+            indices = np.sort(indices)
+        nocorr_, fdrcorr_ = func(take_from[indices], a, q=q, n_sam=n_sam)
+        nocorr += nocorr_
+        fdrcorr += fdrcorr_
+    return nocorr, fdrcorr
+
+
+class SignificancePool:
+    """
+    Bootstrapped KS field significance against a fixed take_from, for many to_test fields (e.g. all panels of a figure). take_from is copied once into shared memory and read by one persistent pool whose workers draw their own resampling indices in batches. For the searchsorted method take_from is sorted along time once, unless presorted is True. Use as a context manager or call close().
+    """
+
+    def __init__(
+        self,
+        take_from: np.ndarray | xr.DataArray,
+        method: Literal["cumsum", "searchsorted"] = "cumsum",
+        presorted: bool = False,
+        processes: int = N_WORKERS,
+        batch_size: int = 10,
+    ) -> None:
+        if isinstance(take_from, xr.DataArray):
+            take_from = take_from.values
+        self.method = method
+        self.processes = processes
+        self.batch_size = batch_size
+        self.shape = take_from.shape
+        self.shm = None
+        self.pool = None
+        self.take_from = None
+        if processes > 1:
+            self.shm = shared_memory.SharedMemory(create=True, size=take_from.nbytes)
+            shared = np.ndarray(take_from.shape, dtype=take_from.dtype, buffer=self.shm.buf)
+            shared[:] = take_from
+        else:
+            shared = np.array(take_from)
+        if method == "searchsorted" and not presorted:
+            shared.sort(axis=0)
+        if processes > 1:
+            self.pool = Pool(
+                processes=processes,
+                initializer=_init_significance_worker,
+                initargs=(self.shm.name, shared.shape, shared.dtype.str),
+            )
+        else:
+            self.take_from = shared
+
+    def test(
+        self,
+        to_test: xr.DataArray,
+        n_sel: int = 100,
+        q: float = 0.02,
+        seed: int | None = None,
+    ) -> Tuple[xr.DataArray, xr.DataArray]:
+        a = to_test.values
+        if self.method == "searchsorted":
+            a = np.sort(a, axis=0)
+        n_batches = -(-n_sel // self.batch_size)
+        sizes = [self.batch_size] * (n_batches - 1) + [n_sel - self.batch_size * (n_batches - 1)]
+        tasks = list(zip(np.random.SeedSequence(seed).spawn(n_batches), sizes))
+        func = partial(
+            _significance_batch, a=a, q=q, method=self.method, take_from=self.take_from
+        )
+        if self.pool is not None:
+            results = self.pool.map(func, tasks)
+        else:
+            results = list(map(func, tasks))
+        nocorr, fdrcorr = zip(*results)
+        nocorr = to_test[0].copy(data=np.sum(nocorr, axis=0) > (1 - q) * n_sel)
+        fdrcorr = to_test[0].copy(data=np.sum(fdrcorr, axis=0) > (1 - q) * n_sel)
+        return nocorr, fdrcorr
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.take_from = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self) -> "SignificancePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
 def field_significance_v2(
     to_test: xr.DataArray,
     take_from: np.ndarray,
@@ -171,31 +468,10 @@ def field_significance_v2(
     q: float = 0.02,
     method: str = "cumsum",
     processes: int = N_WORKERS,
-    chunksize: int = 2,
+    presorted: bool = False,
+    seed: int | None = None,
+    batch_size: int = 10,
 ) -> Tuple[xr.DataArray, xr.DataArray]:
-    # Cumsum implementation is slightly less robust (tie problem) but so much faster
-    nocorr = np.zeros((take_from.shape[1:]), dtype=int)
-    fdrcorr = np.zeros((take_from.shape[1:]), dtype=int)
-    a = to_test.values
-    if method == "searchsorted":
-        a = np.sort(a, axis=0)
-        # b should be sorted as well but it's expensive to do it here, instead sort take_from before calling (since it's usually needed in many calls)
-    n_sam = len(a)
-    indices = np.random.rand(n_sel, take_from.shape[0]).argpartition(n_sam, axis=1)[
-        :, :n_sam
-    ]
-    if method == "searchsorted":
-        indices = np.sort(indices, axis=1)
-        func = partial(one_ks_searchsorted, a=a, q=q, n_sam=n_sam)
-    else:
-        func = partial(one_ks_cumsum, a=a, q=q, n_sam=n_sam)
-
-    with Pool(processes=processes) as pool:
-        results = pool.map(
-            func, (take_from[indices_] for indices_ in indices), chunksize=chunksize
-        )
-    nocorr, fdrcorr = zip(*results)
-    nocorr = to_test[0].copy(data=np.sum(nocorr, axis=0) > (1 - q) * n_sel)
-    fdrcorr = to_test[0].copy(data=np.sum(fdrcorr, axis=0) > (1 - q) * n_sel)
-    return nocorr, fdrcorr
-
+    # Cumsum implementation is slightly less robust (tie problem) but so much faster. To test many fields against the same take_from, use one SignificancePool instead
+    with SignificancePool(take_from, method, presorted, processes, batch_size) as pool:
+        return pool.test(to_test, n_sel, q, seed)
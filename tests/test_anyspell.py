@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+anyspell = pytest.importorskip("jetstream_hugo.anyspell")
+
+
+@pytest.fixture
+def no_spells():
+    time = pd.date_range("2000-01-01", "2001-12-31")
+    da = xr.DataArray(
+        np.zeros((len(time), 3)), coords={"time": time, "region": [0, 1, 2]}
+    )
+    ds = xr.Dataset({"a": da, "b": da.isel(region=0, drop=True)})
+    return da, ds
+
+
+def test_spells_from_da_no_spells(no_spells):
+    da, _ = no_spells
+    spells_ts, spells = anyspell.spells_from_da(da, output_type="list")
+    assert [len(ts) for ts in spells_ts] == [0, 0, 0]
+    assert [len(sp) for sp in spells] == [0, 0, 0]
+    spells_ts, spells = anyspell.spells_from_da(da.isel(region=0), output_type="list")
+    assert len(spells_ts) == 0
+    assert spells.shape == (0, 2)
+
+
+def test_mask_from_spells_no_spells(no_spells):
+    da, ds = no_spells
+    masked = anyspell.mask_from_da(da.isel(region=0), ds)
+    assert masked.sizes["spell"] == 0
+    spells_ts, spells = anyspell.spells_from_da(da, output_type="list")
+    masked = anyspell.mask_from_spells_multi_region(ds, da, spells_ts, spells)
+    assert masked.sizes["spell"] == 0
+    assert masked.sizes["region"] == 3
+
+
+def test_mask_from_spells_multi_region_keeps_region_offsets():
+    time = pd.date_range("2000-01-01", "2000-12-31")
+    da = xr.DataArray(
+        np.arange(2 * len(time), dtype=float).reshape(len(time), 2),
+        coords={"time": time, "region": [0, 1]},
+    )
+    ds = xr.Dataset({"a": da.isel(region=0, drop=True)})
+    day = np.timedelta64(1, "D")
+    spell = lambda start, end, before: (
+        pd.date_range(np.datetime64(start) - before * day, end).values
+    )
+    # the longest spell of region 0 is cut one day before its start, the others three days
+    all_spells_ts = [
+        [spell("2000-01-10", "2000-01-20", 1), spell("2000-02-01", "2000-02-03", 3)],
+        [spell("2000-03-01", "2000-03-02", 3)],
+    ]
+    all_spells = [
+        np.array([["2000-01-10", "2000-01-20"], ["2000-02-01", "2000-02-03"]], dtype="datetime64[ns]"),
+        np.array([["2000-03-01", "2000-03-02"]], dtype="datetime64[ns]"),
+    ]
+    masked = anyspell.mask_from_spells_multi_region(ds, da, all_spells_ts, all_spells)
+    early = masked["a"].sel(time_around_beg=[-3 * day, -2 * day])
+    assert early.sel(region=0).isnull().all()
+    assert early.sel(region=1, spell=0).notnull().all()
+    with pytest.warns(DeprecationWarning):
+        anyspell.mask_from_spells_multi_region(
+            ds, da, all_spells_ts, all_spells, time_before=pd.Timedelta(3, "D")
+        )
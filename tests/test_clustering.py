@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+clustering = pytest.importorskip("jetstream_hugo.clustering")
+
+
+def test_pca_scores_follow_recomputed_components(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((200, 12)).astype(np.float32)
+    exp = object.__new__(clustering.Experiment)
+    exp.path = tmp_path
+    exp.prepare_for_clustering = lambda: (X, None)
+    exp.compute_pcas(4, engine="full")
+    before = np.array(exp.pca_transform(X, 4))
+
+    X_other = X * np.linspace(0.1, 3, X.shape[1]).astype(np.float32)
+    exp.prepare_for_clustering = lambda: (X_other, None)
+    exp.compute_pcas(4, force=True, engine="full")
+    after = np.array(exp.pca_transform(X, 4))
+
+    components, mean = exp.load_pcas(4)
+    expected = (X - mean[None, :]) @ np.asarray(components[:4]).T
+    assert not np.allclose(before, after)
+    np.testing.assert_allclose(after, expected, rtol=1e-4, atol=1e-4)
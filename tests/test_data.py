@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+data = pytest.importorskip("jetstream_hugo.data")
+
+
+def _harmonics(trunc_kept: bool) -> xr.DataArray:
+    lat = np.arange(-88.75, 90, 2.5)
+    lon = np.arange(0, 360, 2.5)
+    phi, lam = np.meshgrid(np.deg2rad(lat), np.deg2rad(lon), indexing="ij")
+    if trunc_kept:
+        values = np.sin(phi) * np.cos(phi) * np.cos(lam)  # degree 2, order 1
+    else:
+        values = np.cos(phi) ** 20 * np.cos(20 * lam)  # degree 20, order 20
+    values = np.stack([values, 2 * values])
+    return xr.DataArray(
+        values, coords={"time": [0, 1], "lat": lat, "lon": lon}, dims=("time", "lat", "lon")
+    )
+
+
+def test_spharm_smoothing_keeps_low_degrees():
+    da = _harmonics(True)
+    smoothed = data.spharm_smoothing(da, 10)
+    np.testing.assert_allclose(smoothed.values, da.values, atol=1e-8)
+
+
+def test_spharm_smoothing_removes_high_degrees():
+    da = _harmonics(False)
+    smoothed = data.spharm_smoothing(da, 10)
+    np.testing.assert_allclose(smoothed.values, 0, atol=1e-8)
+
+
+def test_smooth_dataset_with_spharm():
+    ds = xr.Dataset({"low": _harmonics(True), "high": _harmonics(False)})
+    smoothed = data.smooth(ds, {"lat": ("trunc", 10)})
+    assert isinstance(smoothed, xr.Dataset)
+    np.testing.assert_allclose(smoothed["low"].values, ds["low"].values, atol=1e-8)
+    np.testing.assert_allclose(smoothed["high"].values, 0, atol=1e-8)